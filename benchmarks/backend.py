@@ -0,0 +1,69 @@
+"""
+Per-batch latency of the text-vector1d embedding on the eager model against the exported
+TorchScript and ONNX Runtime graphs (ONNX only when onnxruntime is installed), and the cosine
+drift of each exported graph from the eager embeddings.
+"""
+
+import argparse
+import os
+import tempfile
+
+import numpy as np
+import torch
+
+from common import encode_config, latency_summary, synthetic_questions, timed, tiny_bert
+from sts.utils.backend import EXPORT_BACKENDS, TextVectorModule
+from sts.utils.embedder import TransformersEmbedder
+
+
+def cosine_drift(a, b):
+    return 1 - np.sum(a * b, axis=1) / (np.linalg.norm(a, axis=1) * np.linalg.norm(b, axis=1))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--queries', default=64, type=int)
+    parser.add_argument('--hidden-size', default=256, type=int)
+    parser.add_argument('--layers', default=12, type=int)
+    parser.add_argument('--threads', default=1, type=int)
+    parser.add_argument('--batch-sizes', default=[1, 16], type=int, nargs='+')
+    args = parser.parse_args()
+
+    torch.set_num_threads(args.threads)
+    tokenizer, model = tiny_bert(hidden_size=args.hidden_size, num_hidden_layers=args.layers)
+    config = encode_config()
+    questions = synthetic_questions(args.queries)
+    device = torch.device('cpu')
+
+    def eager(texts):
+        return TransformersEmbedder.batch_text_vector(texts=texts,
+                                                      pretrained_model=model,
+                                                      tokenizer=tokenizer,
+                                                      encode_config=config,
+                                                      device=device,
+                                                      return_tensors=False)
+
+    embedders = {'pytorch': eager}
+    export_dirpath = tempfile.mkdtemp()
+    module = TextVectorModule(model)
+    example = TransformersEmbedder.batch_encode(questions[:2], tokenizer, config)
+    for name, backend in EXPORT_BACKENDS.items():
+        path = os.path.join(export_dirpath, f'text_vector.{backend.extension}')
+        try:
+            backend.export(module, *example, path)
+            exported = backend(path, device)
+        except ImportError as e:
+            print(f'{name}: skipped ({e})')
+            continue
+        embedders[name] = lambda texts, exported=exported: exported(
+            *TransformersEmbedder.batch_encode(texts, tokenizer, config))
+
+    reference = eager(questions)
+    for batch_size in args.batch_sizes:
+        batches = [questions[start:start + batch_size] for start in range(0, len(questions), batch_size)]
+        for name, embed in embedders.items():
+            embed(batches[0])
+            latencies = [timed(embed, batch)[1][0] for batch in batches]
+            drift = cosine_drift(reference, np.vstack([embed(batch) for batch in batches]))
+            print('batch {:>3}, {:>11}: p50 {p50_ms:7.2f} ms, p99 {p99_ms:7.2f} ms, max cosine drift {:.1e}'.format(
+                batch_size, name, drift.max(), **latency_summary(latencies)))
@@ -0,0 +1,69 @@
+"""
+Load test of the query micro-batcher: concurrent clients each send questions one after another,
+and throughput and per-query latency are reported for direct per-query forward passes and
+for several max batch size / max wait settings.
+"""
+
+import argparse
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import torch
+
+from common import encode_config, latency_summary, synthetic_questions, tiny_bert
+from sts.utils.batcher import MicroBatcher
+from sts.utils.embedder import TransformersEmbedder
+
+
+def load_test(embed_one, questions, clients):
+    latencies = []
+    lock = threading.Lock()
+
+    def client(client_questions):
+        for question in client_questions:
+            start = time.perf_counter()
+            embed_one(question)
+            with lock:
+                latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(clients) as executor:
+        list(executor.map(client, [questions[i::clients] for i in range(clients)]))
+    return len(questions) / (time.perf_counter() - start), latencies
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--queries', default=512, type=int)
+    parser.add_argument('--clients', default=16, type=int)
+    parser.add_argument('--hidden-size', default=256, type=int)
+    parser.add_argument('--threads', default=1, type=int)
+    parser.add_argument('--batch-sizes', default=[4, 16, 32], type=int, nargs='+')
+    parser.add_argument('--waits-ms', default=[0, 2, 10], type=float, nargs='+')
+    args = parser.parse_args()
+
+    torch.set_num_threads(args.threads)
+    tokenizer, model = tiny_bert(hidden_size=args.hidden_size)
+    config = encode_config()
+    questions = synthetic_questions(args.queries)
+
+    def embed(texts):
+        return TransformersEmbedder.batch_text_vector(texts=texts,
+                                                      pretrained_model=model,
+                                                      tokenizer=tokenizer,
+                                                      encode_config=config,
+                                                      return_tensors=False)
+
+    embed(questions[:1])
+    throughput, latencies = load_test(lambda question: embed([question]), questions, args.clients)
+    print('{:>22}: {:7.1f} q/s, p50 {p50_ms:7.2f} ms, p99 {p99_ms:7.2f} ms'.format(
+        'unbatched', throughput, **latency_summary(latencies)))
+    for batch_size in args.batch_sizes:
+        for wait_ms in args.waits_ms:
+            batcher = MicroBatcher(lambda texts: list(embed(texts)), max_batch_size=batch_size, max_wait_ms=wait_ms)
+            throughput, latencies = load_test(lambda question: batcher.submit(question).result(),
+                                              questions, args.clients)
+            print('{:>22}: {:7.1f} q/s, p50 {p50_ms:7.2f} ms, p99 {p99_ms:7.2f} ms, mean batch {:.1f}'.format(
+                f'batch {batch_size}, wait {wait_ms:g} ms', throughput, batcher.stats()['mean_batch_size'],
+                **latency_summary(latencies)))
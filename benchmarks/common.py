@@ -0,0 +1,79 @@
+import json
+import os
+import random
+import resource
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+ROOT_DIRPATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT_DIRPATH, 'src'))
+os.environ.setdefault('DEFAULT_DEVICE', 'cpu')
+
+import torch
+from transformers import BertConfig, BertModel, BertTokenizer
+
+VOCABULARY = (
+    "covid 19 coronavirus vaccine vaccinated vaccination children older people mask masks wear "
+    "how what when where who why can should is are do does get spread transmitted symptoms "
+    "risk safe safety long virus disease test testing quarantine isolation travel home work "
+    "school hands wash distance immunity dose doses booster variant omicron delta fever cough "
+    "the a an of to in on for with from after before during my our it they i you we"
+).split()
+
+ENCODE_CONFIG_PATH = os.path.join(ROOT_DIRPATH, 'config', 'sts', 'pretrained_config',
+                                  'digitalepidemiologylab', 'covid-twitter-bert', 'tokenizer.json')
+
+
+def encode_config():
+    with open(ENCODE_CONFIG_PATH) as JSON:
+        return json.loads(JSON.read())
+
+
+def tiny_bert(hidden_size=128, num_hidden_layers=12, num_attention_heads=4, random_state=108):
+    # randomly initialized stand-in for CT-BERT, so benchmarks run without downloading weights
+    vocab_path = os.path.join(tempfile.mkdtemp(), 'vocab.txt')
+    with open(vocab_path, 'w') as f:
+        f.write('\n'.join(['[PAD]', '[UNK]', '[CLS]', '[SEP]', '[MASK]'] + VOCABULARY))
+    tokenizer = BertTokenizer(vocab_path)
+    torch.manual_seed(random_state)
+    config = BertConfig(vocab_size=len(tokenizer),
+                        hidden_size=hidden_size,
+                        num_hidden_layers=num_hidden_layers,
+                        num_attention_heads=num_attention_heads,
+                        intermediate_size=4 * hidden_size,
+                        output_hidden_states=True,
+                        return_dict=False)
+    return tokenizer, BertModel(config).eval()
+
+
+def synthetic_questions(n, min_words=5, max_words=20, random_state=108):
+    rng = random.Random(random_state)
+    return [' '.join(rng.choice(VOCABULARY) for _ in range(rng.randint(min_words, max_words))) + '?'
+            for _ in range(n)]
+
+
+def timed(fn, *args, repeat=1, **kwargs):
+    latencies = []
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn(*args, **kwargs)
+        latencies.append(time.perf_counter() - start)
+    return result, np.array(latencies)
+
+
+def latency_summary(latencies):
+    latencies = np.asarray(latencies) * 1000
+    return {
+        'mean_ms': float(latencies.mean()),
+        'p50_ms': float(np.percentile(latencies, 50)),
+        'p99_ms': float(np.percentile(latencies, 99))
+    }
+
+
+def peak_rss_mb():
+    # ru_maxrss is reported in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
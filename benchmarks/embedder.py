@@ -0,0 +1,61 @@
+"""
+Per-query latency and peak memory of TransformersEmbedder.text_vector against the former
+path, which stacked every hidden state and copied it to the CPU before pooling one layer.
+Each mode runs in its own process so that the peak RSS figures do not mix.
+"""
+
+import argparse
+import multiprocessing
+
+import torch
+
+from common import encode_config, latency_summary, peak_rss_mb, synthetic_questions, timed, tiny_bert
+
+
+def all_hidden_states_text_vector(text, pretrained_model, tokenizer, encode_config):
+    from sts.utils.embedder import TransformersEmbedder
+    hidden_states = TransformersEmbedder.extract_features(text=text,
+                                                          pretrained_model=pretrained_model,
+                                                          tokenizer=tokenizer,
+                                                          encode_config=encode_config)[2]
+    token_embeddings = torch.squeeze(hidden_states, dim=1).permute(1, 0, 2)
+    token_vecs_sum = [torch.sum(token[-4:], dim=0) for token in token_embeddings]
+    return torch.mean(hidden_states[-2][0], dim=0).numpy()
+
+
+def lean_text_vector(text, pretrained_model, tokenizer, encode_config):
+    from sts.utils.embedder import TransformersEmbedder
+    return TransformersEmbedder.text_vector(text=text,
+                                            pretrained_model=pretrained_model,
+                                            tokenizer=tokenizer,
+                                            encode_config=encode_config,
+                                            return_tensors=False)
+
+
+def run(mode, args):
+    torch.set_num_threads(args.threads)
+    tokenizer, model = tiny_bert(hidden_size=args.hidden_size, num_hidden_layers=args.layers)
+    embed = all_hidden_states_text_vector if mode == 'all-hidden-states' else lean_text_vector
+    config = encode_config()
+    queries = synthetic_questions(args.queries)
+    embed(queries[0], model, tokenizer, config)
+    latencies = []
+    for query in queries:
+        latencies.extend(timed(embed, query, model, tokenizer, config)[1])
+    return dict(mode=mode, peak_rss_mb=peak_rss_mb(), **latency_summary(latencies))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--queries', default=200, type=int)
+    parser.add_argument('--hidden-size', default=256, type=int)
+    parser.add_argument('--layers', default=12, type=int)
+    parser.add_argument('--threads', default=1, type=int)
+    args = parser.parse_args()
+
+    context = multiprocessing.get_context('spawn')
+    for mode in ['all-hidden-states', 'lean']:
+        with context.Pool(1) as pool:
+            result = pool.apply(run, (mode, args))
+        print('{mode:>18}: mean {mean_ms:.2f} ms, p50 {p50_ms:.2f} ms, '
+              'p99 {p99_ms:.2f} ms, peak rss {peak_rss_mb:.0f} MB'.format(**result))
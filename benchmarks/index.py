@@ -0,0 +1,61 @@
+"""
+Recall against the exact index and per-query latency of the IVF index for several nprobe values,
+on synthetic clustered unit vectors standing in for FAQ embeddings.
+"""
+
+import argparse
+
+import numpy as np
+
+from common import latency_summary, timed
+from sts.utils.index import ExactIndex, IVFIndex
+
+
+def unit(embeddings):
+    return (embeddings / np.linalg.norm(embeddings, axis=1, keepdims=True)).astype(np.float32)
+
+
+def synthetic_embeddings(n, dim, n_topics=200, noise=2.0, random_state=108):
+    rng = np.random.RandomState(random_state)
+    topics = rng.randn(n_topics, dim)
+    return unit(topics[rng.randint(n_topics, size=n)] + noise * rng.randn(n, dim))
+
+
+def paraphrases(embeddings, n, noise=0.05, random_state=108):
+    # user questions land near a stored FAQ without being identical to it
+    rng = np.random.RandomState(random_state)
+    sources = embeddings[rng.randint(len(embeddings), size=n)]
+    return unit(sources + noise * rng.randn(*sources.shape))
+
+
+def recall(labels, exact_labels):
+    return float(np.mean([len(set(a) & set(b)) / len(b) for a, b in zip(labels, exact_labels)]))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--size', default=20000, type=int)
+    parser.add_argument('--dim', default=1024, type=int)
+    parser.add_argument('--queries', default=200, type=int)
+    parser.add_argument('--nbest', default=5, type=int)
+    parser.add_argument('--nlist', default=128, type=int)
+    args = parser.parse_args()
+
+    embeddings = synthetic_embeddings(args.size, args.dim)
+    queries = paraphrases(embeddings, args.queries)
+    labels = np.arange(args.size)
+
+    exact, build_latency = timed(ExactIndex().add, labels, embeddings)
+    exact_labels = exact.search(queries, args.nbest)[0]
+    latencies = [timed(exact.search, query[np.newaxis], args.nbest)[1][0] for query in queries]
+    print('exact: build {:.0f} ms, query p50 {p50_ms:.2f} ms, p99 {p99_ms:.2f} ms'.format(
+        build_latency[0] * 1000, **latency_summary(latencies)))
+
+    ivf, build_latency = timed(IVFIndex(nlist=args.nlist).add, labels, embeddings)
+    print(f'ivf (nlist={args.nlist}): build {build_latency[0] * 1000:.0f} ms')
+    for nprobe in [1, 2, 4, 8, 16, 32]:
+        ivf.nprobe = nprobe
+        ivf_labels = ivf.search(queries, args.nbest)[0]
+        latencies = [timed(ivf.search, query[np.newaxis], args.nbest)[1][0] for query in queries]
+        print('  nprobe {:>2}: recall@{} {:.3f}, query p50 {p50_ms:.2f} ms, p99 {p99_ms:.2f} ms'.format(
+            nprobe, args.nbest, recall(ivf_labels, exact_labels), **latency_summary(latencies)))
@@ -0,0 +1,78 @@
+"""
+Per-query time of TextPreprocessor.normalize_text with the CT-BERT preprocessing config,
+on synthetic questions and on questions that trigger the rewrite tables, plus the import time
+of the preprocessor, the cost of hashtag segmentation before and after it is memoized and the
+throughput of bulk normalization for several worker counts.
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+from common import ROOT_DIRPATH, latency_summary, synthetic_questions, timed
+
+PREPROCESSING_CONFIG_PATH = os.path.join(ROOT_DIRPATH, 'config', 'sts', 'pretrained_config',
+                                         'digitalepidemiologylab', 'covid-twitter-bert', 'preprocessing.json')
+
+NOISY_QUESTIONS = [
+    "It's been 3yr, can ppl in the U.S get the #COVID19 booster w/ a cold?? lol",
+    "don\x89Ûªt know if it\x89Ûªs safe… @WHO http://who.int/covid-19 #StayHome",
+    "Is the “Omicron” variant worse than Delta – or not?\t\n"
+]
+
+HASHTAGS = ['StayHomeSaveLives', 'COVID19Vaccine', 'WearAMask', 'FlattenTheCurve', 'SocialDistancing',
+            'WashYourHands', 'BoosterShot', 'TestTraceIsolate']
+
+IMPORT_TIMER = """
+import sys, time
+sys.path.insert(0, {src!r})
+start = time.perf_counter()
+from sts.utils.preprocessor import TextPreprocessor
+print(time.perf_counter() - start)
+"""
+
+
+def import_seconds():
+    # a fresh interpreter, so nothing is already imported
+    code = IMPORT_TIMER.format(src=os.path.join(ROOT_DIRPATH, 'src'))
+    return float(subprocess.run([sys.executable, '-c', code], check=True, stdout=subprocess.PIPE,
+                                universal_newlines=True).stdout.split()[-1])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--queries', default=2000, type=int)
+    parser.add_argument('--workers', default=[1, 2, 4], type=int, nargs='+')
+    args = parser.parse_args()
+
+    print(f'import: {import_seconds() * 1000:.0f} ms')
+    from sts.utils.preprocessor import TextPreprocessor
+
+    start = time.perf_counter()
+    TextPreprocessor.segment_hashtag(HASHTAGS[0])
+    print(f'first hashtag (loads the segmenter): {(time.perf_counter() - start) * 1000:.0f} ms')
+    TextPreprocessor._hashtag_segmentations.clear()
+    cold = [timed(TextPreprocessor.segment_hashtag, hashtag)[1][0] for hashtag in HASHTAGS]
+    warm = [timed(TextPreprocessor.segment_hashtag, hashtag)[1][0] for hashtag in HASHTAGS]
+    print('hashtag: segmented {:.3f} ms, memoized {:.4f} ms per hashtag'.format(
+        latency_summary(cold)['mean_ms'], latency_summary(warm)['mean_ms']))
+
+    with open(PREPROCESSING_CONFIG_PATH) as JSON:
+        config = json.loads(JSON.read())
+    corpora = {
+        'plain': synthetic_questions(args.queries),
+        'noisy': NOISY_QUESTIONS * (args.queries // len(NOISY_QUESTIONS))
+    }
+    for name, questions in corpora.items():
+        TextPreprocessor.normalize_text(questions[0], config=config)
+        latencies = [timed(TextPreprocessor.normalize_text, question, config=config)[1][0] for question in questions]
+        print('{:>5}: mean {mean_ms:.3f} ms, p50 {p50_ms:.3f} ms, p99 {p99_ms:.3f} ms per query'.format(
+            name, **latency_summary(latencies)))
+
+    questions = synthetic_questions(args.queries * 10)
+    for workers in args.workers:
+        latency = timed(TextPreprocessor.normalize_texts, questions, n_jobs=workers, config=config)[1][0]
+        print(f'bulk, {workers} workers: {len(questions) / latency:.0f} texts/s')
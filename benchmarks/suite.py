@@ -0,0 +1,277 @@
+"""
+Offline benchmark of the retrieval pipeline on synthetic FAQ corpora of several sizes, with the
+tiny randomly initialized BERT standing in for CT-BERT and the padding and index settings of
+config/sts/config.json. For each size it measures, in a fresh process:
+- preprocessing throughput of TextPreprocessor.normalize_texts
+- embedding throughput in batches of batch_size
+- index build time
+- end-to-end query latency: normalize, embed and search one question
+- peak RSS of the process
+Throughput is measured on at most --max-texts texts of the corpus. The index is built on
+synthetic embeddings for the whole corpus, so large sizes do not have to be embedded.
+Then, in another fresh process, the same steps run end to end through
+SemanticTextualSimilarityPipeline on the first --max-texts questions, with its embedding store,
+query cache and micro-batcher:
+- building the FAQ set, cold and again from the embedding store
+- update_stored_texts with 1% of the questions changed
+- query latency on query cache misses and hits, one client at a time
+- throughput and mean micro-batch size with --clients concurrent clients
+Results are written as JSON, keyed by the current commit, and --baseline prints the change
+against an earlier results file.
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import shutil
+import subprocess
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+import torch
+import transformers
+
+from common import ROOT_DIRPATH, encode_config, latency_summary, peak_rss_mb, synthetic_questions, timed, tiny_bert
+from index import synthetic_embeddings, unit
+from preprocessing import PREPROCESSING_CONFIG_PATH
+
+MAIN_CONFIG_PATH = os.path.join(ROOT_DIRPATH, 'config', 'sts', 'config.json')
+TINY_BERT_NAME = 'tiny-bert'
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT_DIRPATH, check=True,
+                              stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                              universal_newlines=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def new_index(main_config):
+    from sts.utils.index import ExactIndex, IVFIndex
+    if main_config['index_type'] == IVFIndex.index_type:
+        return IVFIndex(nlist=main_config['ivf_nlist'], nprobe=main_config['ivf_nprobe'],
+                        random_state=main_config['random_state'])
+    return ExactIndex()
+
+
+def run(size, args):
+    from sts.utils.embedder import TransformersEmbedder
+    from sts.utils.preprocessor import TextPreprocessor
+
+    torch.set_num_threads(args.threads)
+    baseline_rss_mb = peak_rss_mb()
+    with open(MAIN_CONFIG_PATH) as JSON:
+        main_config = json.loads(JSON.read())
+    with open(PREPROCESSING_CONFIG_PATH) as JSON:
+        preprocessing_config = json.loads(JSON.read())
+    tokenizer, model = tiny_bert(hidden_size=args.hidden_size, num_hidden_layers=args.layers)
+    config = encode_config()
+    dynamic_padding = main_config['padding'] == 'dynamic'
+    batch_size = main_config['batch_size']
+
+    def embed(norm_texts):
+        return TransformersEmbedder.batch_text_vector(texts=norm_texts,
+                                                      pretrained_model=model,
+                                                      tokenizer=tokenizer,
+                                                      encode_config=config,
+                                                      return_tensors=False,
+                                                      dynamic_padding=dynamic_padding)
+
+    texts = synthetic_questions(min(size, args.max_texts), random_state=size)
+    norm_texts, latency = timed(TextPreprocessor.normalize_texts, texts, n_jobs=args.preprocessing_workers,
+                                config=preprocessing_config)
+    preprocessing = {'texts': len(texts), 'texts_per_s': len(texts) / latency[0]}
+
+    embed(norm_texts[:batch_size])
+    start = time.perf_counter()
+    for i in range(0, len(norm_texts), batch_size):
+        embed(norm_texts[i:i + batch_size])
+    embedding = {'texts': len(norm_texts), 'batch_size': batch_size,
+                 'texts_per_s': len(norm_texts) / (time.perf_counter() - start)}
+
+    embeddings = synthetic_embeddings(size, args.hidden_size, random_state=size)
+    index, latency = timed(new_index(main_config).add, np.arange(size), embeddings)
+    index_build = {'index_type': main_config['index_type'], 'ms': float(latency[0] * 1000)}
+
+    def answer(question):
+        norm_text = TextPreprocessor.normalize_text(question, config=preprocessing_config)
+        return index.search(unit(embed([norm_text])), args.nbest)
+
+    queries = synthetic_questions(args.queries, random_state=size + 1)
+    answer(queries[0])
+    latencies = [timed(answer, query)[1][0] for query in queries]
+    query = dict(queries=len(queries), nbest=args.nbest, **latency_summary(latencies))
+
+    return {
+        'size': size,
+        'preprocessing': preprocessing,
+        'embedding': embedding,
+        'index_build': index_build,
+        'query': query,
+        'baseline_rss_mb': baseline_rss_mb,
+        'peak_rss_mb': peak_rss_mb()
+    }
+
+
+def pipeline_config_dirpath(dirpath, args):
+    # config/sts with CT-BERT's preprocessing, tokenizer and model configs for the tiny BERT, which is
+    # saved under dirpath and loaded by its name relative to dirpath
+    tokenizer, model = tiny_bert(hidden_size=args.hidden_size, num_hidden_layers=args.layers)
+    tokenizer.save_pretrained(os.path.join(dirpath, TINY_BERT_NAME))
+    model.save_pretrained(os.path.join(dirpath, TINY_BERT_NAME))
+    config_dirpath = os.path.join(dirpath, 'config')
+    shutil.copytree(os.path.dirname(PREPROCESSING_CONFIG_PATH),
+                    os.path.join(config_dirpath, 'pretrained_config', TINY_BERT_NAME))
+    with open(MAIN_CONFIG_PATH) as JSON:
+        main_config = json.loads(JSON.read())
+    main_config.update(device='cpu', selected_pretrained_model=TINY_BERT_NAME)
+    with open(os.path.join(config_dirpath, 'config.json'), 'w') as JSON:
+        JSON.write(json.dumps(main_config))
+    return config_dirpath
+
+
+def run_pipeline(size, args):
+    from sts import SemanticTextualSimilarityPipeline
+
+    torch.set_num_threads(args.threads)
+    dirpath = tempfile.mkdtemp()
+    config_dirpath = pipeline_config_dirpath(dirpath, args)
+    os.chdir(dirpath)
+    os.environ['EMBEDDING_CACHE_DIRPATH'] = os.path.join(dirpath, 'embeddings')
+    os.environ.pop('HASHTAG_CACHE_PATH', None)
+
+    texts = pd.Series(synthetic_questions(min(size, args.max_texts), random_state=size))
+    pipeline, cold = timed(SemanticTextualSimilarityPipeline, config_dirpath=config_dirpath, stored_texts=texts)
+    # a second pipeline, as a restarted server would build it, reads the embeddings back from the store
+    _, warm = timed(SemanticTextualSimilarityPipeline, config_dirpath=config_dirpath, stored_texts=texts)
+    changed = max(1, len(texts) // 100)
+    updated = texts.copy()
+    updated.iloc[:changed] = synthetic_questions(changed, random_state=size + 2)
+    _, update = timed(pipeline.update_stored_texts, updated)
+    build = {'texts': len(texts), 'cold_ms': float(cold[0] * 1000), 'warm_ms': float(warm[0] * 1000),
+             'update_changed': changed, 'update_ms': float(update[0] * 1000)}
+
+    queries = synthetic_questions(args.queries, random_state=size + 1)
+    pipeline.get_stored_best_matches(queries[0], nbest=args.nbest)
+    misses = [timed(pipeline.get_stored_best_matches, query, nbest=args.nbest)[1][0] for query in queries[1:]]
+    hits = [timed(pipeline.get_stored_best_matches, query, nbest=args.nbest)[1][0] for query in queries[1:]]
+    query = {}
+    for name, latencies in [('miss', misses), ('hit', hits)]:
+        query.update({f'{name}_{key}': value for key, value in latency_summary(latencies).items()})
+
+    queries = synthetic_questions(args.queries, random_state=size + 3)
+    batcher_stats = pipeline.query_batcher_stats()
+    with ThreadPoolExecutor(args.clients) as executor:
+        start = time.perf_counter()
+        list(executor.map(lambda question: pipeline.get_stored_best_matches(question, nbest=args.nbest), queries))
+        elapsed = time.perf_counter() - start
+    concurrent = {'clients': args.clients, 'queries_per_s': len(queries) / elapsed}
+    if batcher_stats:
+        batches = pipeline.query_batcher_stats()['batches'] - batcher_stats['batches']
+        items = pipeline.query_batcher_stats()['items'] - batcher_stats['items']
+        concurrent['mean_batch_size'] = items / batches if batches else 0.0
+
+    return {
+        'pipeline_build': build,
+        'pipeline_query': query,
+        'pipeline_concurrent': concurrent,
+        'pipeline_peak_rss_mb': peak_rss_mb()
+    }
+
+
+METRICS = [
+    ('preprocessing', 'texts_per_s', 'preprocessing texts/s'),
+    ('embedding', 'texts_per_s', 'embedding texts/s'),
+    ('index_build', 'ms', 'index build ms'),
+    ('query', 'p50_ms', 'query p50 ms'),
+    ('query', 'p99_ms', 'query p99 ms'),
+    (None, 'baseline_rss_mb', 'rss before the run MB'),
+    (None, 'peak_rss_mb', 'peak rss MB'),
+    ('pipeline_build', 'cold_ms', 'pipeline cold build ms'),
+    ('pipeline_build', 'warm_ms', 'pipeline warm build ms'),
+    ('pipeline_build', 'update_ms', 'pipeline update ms'),
+    ('pipeline_query', 'miss_p50_ms', 'query miss p50 ms'),
+    ('pipeline_query', 'miss_p99_ms', 'query miss p99 ms'),
+    ('pipeline_query', 'hit_p50_ms', 'query hit p50 ms'),
+    ('pipeline_concurrent', 'queries_per_s', 'concurrent queries/s'),
+    ('pipeline_concurrent', 'mean_batch_size', 'mean micro-batch size'),
+    (None, 'pipeline_peak_rss_mb', 'pipeline peak rss MB')
+]
+
+
+def metric(result, section, name):
+    # results of earlier runs may lack the metrics added since
+    return result.get(name) if section is None else result.get(section, dict()).get(name)
+
+
+def print_result(result, baseline=None):
+    print(f'{result["size"]:>7} FAQs:')
+    for section, name, title in METRICS:
+        value = metric(result, section, name)
+        if value is None:
+            continue
+        change = ''
+        if baseline is not None and metric(baseline, section, name):
+            change = ' ({:+.1%})'.format(value / metric(baseline, section, name) - 1)
+        print(f'  {title:>22}: {value:10.2f}{change}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', default=[100, 1000, 10000, 100000], type=int, nargs='+')
+    parser.add_argument('--max-texts', default=2000, type=int,
+                        help='texts preprocessed and embedded per size to measure throughput')
+    parser.add_argument('--queries', default=200, type=int)
+    parser.add_argument('--nbest', default=5, type=int)
+    parser.add_argument('--hidden-size', default=128, type=int)
+    parser.add_argument('--layers', default=12, type=int)
+    parser.add_argument('--threads', default=1, type=int)
+    parser.add_argument('--preprocessing-workers', default=1, type=int)
+    parser.add_argument('--clients', default=8, type=int, help='concurrent clients querying the pipeline')
+    parser.add_argument('--output', default=None, type=str,
+                        help='benchmarks/results/<commit>.json by default')
+    parser.add_argument('--baseline', default=None, type=str, help='earlier results file to compare with')
+    args = parser.parse_args()
+
+    commit = git_commit()
+    output = args.output or os.path.join(ROOT_DIRPATH, 'benchmarks', 'results', f'{commit}.json')
+    baselines = dict()
+    if args.baseline is not None:
+        with open(args.baseline) as JSON:
+            baselines = {result['size']: result for result in json.loads(JSON.read())['results']}
+
+    results = []
+    # every size in its own process, so that the peak RSS figures do not mix
+    context = multiprocessing.get_context('spawn')
+    for size in args.sizes:
+        with context.Pool(1) as pool:
+            results.append(pool.apply(run, (size, args)))
+        with context.Pool(1) as pool:
+            results[-1].update(pool.apply(run_pipeline, (size, args)))
+        print_result(results[-1], baselines.get(size))
+
+    report = {
+        'commit': commit,
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'machine': {
+            'platform': platform.platform(),
+            'processor': platform.processor(),
+            'cpu_count': os.cpu_count(),
+            'python': platform.python_version(),
+            'torch': torch.__version__,
+            'transformers': transformers.__version__
+        },
+        'args': vars(args),
+        'results': results
+    }
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w') as JSON:
+        JSON.write(json.dumps(report, indent=2))
+    print(f'results written to {output}')
@@ -0,0 +1,90 @@
+"""
+Load test of the Telegram bot's message handler against a local stub of the main API that takes
+a fixed time to answer: simulated updates are replayed through handle_message by a pool of
+handler threads, as the dispatcher does with run_async handlers, and update latency and
+throughput are reported per number of workers.
+"""
+
+import argparse
+import json
+import os
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from types import SimpleNamespace
+from urllib.parse import parse_qs, urlparse
+
+from common import ROOT_DIRPATH, latency_summary, synthetic_questions
+
+
+def stub_main_api(latency_ms):
+    class Handler(BaseHTTPRequestHandler):
+        # keep-alive, so pooled connections are actually reused
+        protocol_version = 'HTTP/1.1'
+        disable_nagle_algorithm = True
+
+        def do_GET(self):
+            time.sleep(latency_ms / 1000)
+            query = parse_qs(urlparse(self.path).query)
+            n_returns = int(query.get('n-returns', ['1'])[0])
+            body = json.dumps({'n-nearest-faqs': [
+                {'question': f'FAQ {i}?', 'answer': f'Answer {i}.', 'score': 0.95} for i in range(n_returns)
+            ]}).encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(('localhost', 0), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def simulated_update(user_id, message_id, text, replies):
+    sent = time.perf_counter()
+    message = SimpleNamespace(text=text,
+                              message_id=message_id,
+                              from_user=SimpleNamespace(id=user_id),
+                              chat=SimpleNamespace(id=user_id),
+                              reply_text=lambda *args, **kwargs: replies.append(time.perf_counter() - sent))
+    return SimpleNamespace(message=message)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--updates', default=400, type=int)
+    parser.add_argument('--users', default=100, type=int)
+    parser.add_argument('--api-latency-ms', default=50, type=float)
+    parser.add_argument('--workers', default=[1, 4, 16, 32], type=int, nargs='+')
+    args = parser.parse_args()
+
+    server = stub_main_api(args.api_latency_ms)
+    with open(os.path.join(ROOT_DIRPATH, 'config', 'telebot.json')) as JSON:
+        config = json.loads(JSON.read())
+    config['main_api_connection'] = {'url': f'http://localhost:{server.server_port}', 'secret_key': 'stub'}
+    config['workers'] = max(args.workers)
+    config_path = os.path.join(tempfile.mkdtemp(), 'telebot.json')
+    with open(config_path, 'w') as JSON:
+        JSON.write(json.dumps(config))
+    os.environ['TELEBOT_CONFIG_PATH'] = config_path
+
+    import telebot
+
+    for workers in args.workers:
+        # fresh questions for every run, so none is answered from the bot's cache
+        questions = synthetic_questions(args.updates, random_state=workers)
+        replies = []
+        updates = [simulated_update(i % args.users, i, question, replies) for i, question in enumerate(questions)]
+        start = time.perf_counter()
+        with ThreadPoolExecutor(workers) as executor:
+            list(executor.map(lambda update: telebot.handle_message(update, None), updates))
+        elapsed = time.perf_counter() - start
+        print('{:>3} workers: {:7.1f} updates/s, p50 {p50_ms:8.1f} ms, p99 {p99_ms:8.1f} ms'.format(
+            workers, len(updates) / elapsed, **latency_summary(replies)))
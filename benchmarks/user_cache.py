@@ -0,0 +1,34 @@
+"""
+Memory of the Telegram bot's user cache while simulated users keep sending questions: the bot
+caches a question, its answer and its feedback data for every message, and peak RSS should stop
+growing once the cache is full.
+"""
+
+import argparse
+
+from common import peak_rss_mb, synthetic_questions
+from data.user_cache import UserCache
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--messages', default=1000000, type=int)
+    parser.add_argument('--users', default=200000, type=int)
+    parser.add_argument('--cache-size', default=100000, type=int)
+    parser.add_argument('--cache-size-per-user', default=200, type=int)
+    parser.add_argument('--checkpoints', default=5, type=int)
+    args = parser.parse_args()
+
+    baseline_rss_mb = peak_rss_mb()
+    cache = UserCache(maxsize=args.cache_size, max_per_user=args.cache_size_per_user)
+    questions = synthetic_questions(10000)
+    nearest_faq = {'question': questions[0], 'answer': ' '.join(questions[:20]), 'score': 0.95}
+    for message_id in range(args.messages):
+        user = message_id % args.users
+        question = questions[message_id % len(questions)]
+        cache.put(user, 'fdbk', message_id, {'user_question': question, 'nearest_faq': nearest_faq})
+        cache.put(user, 'ofaqs', message_id, questions[1:5])
+        cache.put(user, 'pre_question', question, {'nearest_faq': nearest_faq, 'other_faq_questions': questions[1:5]})
+        if (message_id + 1) % (args.messages // args.checkpoints) == 0:
+            stats = cache.stats()
+            print('{:>8} messages: {:>7} entries, {:>7} users, {:>8} evictions, peak rss +{:.0f} MB'.format(
+                message_id + 1, stats['size'], stats['users'], stats['evictions'], peak_rss_mb() - baseline_rss_mb))
@@ -0,0 +1,52 @@
+"""
+Time of WHOFAQCrawler.preprocess against the previous implementation, which rescanned the text
+five times per punctuation mark, on answers extracted from synthetic WHO-like accordion HTML
+of growing size, and whether both produce the same text.
+"""
+
+import argparse
+import random
+import re
+
+from bs4 import BeautifulSoup
+
+from common import VOCABULARY, timed
+from data.who import WHOFAQCrawler
+
+
+def legacy_preprocess(text):
+    punctuations = ['.', ',', '!', '?', ';', ':', '\"', '\'', ')', '(']
+    for p in punctuations:
+        text = text.replace(f'\n{p}', p)
+        text = re.sub(r'\t', ' ', text)
+        text = re.sub(r' {2}', ' ', text)
+        text = re.sub(r'\n\n', '\n', text)
+        text = re.sub(r'\n ', '\n', text)
+        text = re.sub(r' \n', '\n', text)
+    return text
+
+
+def synthetic_answer_html(n_paragraphs, random_state=108):
+    rng = random.Random(random_state)
+    paragraphs = []
+    for _ in range(n_paragraphs):
+        words = [rng.choice(VOCABULARY) for _ in range(rng.randint(10, 60))]
+        # inline markup splits sentences into separate text nodes, as on the WHO pages
+        words[rng.randrange(len(words))] = f'<strong>{rng.choice(VOCABULARY)}</strong>'
+        words[rng.randrange(len(words))] = f'<a href="#">{rng.choice(VOCABULARY)}</a>{rng.choice(".,;:)")}'
+        paragraphs.append('<p>\n  ' + ' '.join(words) + '.\n\t</p>')
+    return '<p class="sf-accordion__summary">' + '<br/>\n'.join(paragraphs) + '</p>'
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--paragraphs', default=[10, 100, 1000, 10000], type=int, nargs='+')
+    args = parser.parse_args()
+
+    for n_paragraphs in args.paragraphs:
+        soup = BeautifulSoup(synthetic_answer_html(n_paragraphs), 'html.parser')
+        answer = soup.find('p', class_='sf-accordion__summary').get_text('\n', strip=True)
+        legacy, legacy_latency = timed(legacy_preprocess, answer)
+        current, latency = timed(WHOFAQCrawler.preprocess, answer)
+        print('{:>6} paragraphs ({:>8} chars): legacy {:8.2f} ms, current {:7.2f} ms, same output: {}'.format(
+            n_paragraphs, len(answer), legacy_latency[0] * 1000, latency[0] * 1000, legacy == current))
@@ -0,0 +1,63 @@
+# gunicorn --pythonpath src "api:create_app()"
+import gc
+import json
+import multiprocessing
+import os
+import shutil
+
+from dotenv import load_dotenv, find_dotenv
+
+load_dotenv(find_dotenv())
+# fast tokenizers disable their own thread pool after a fork with a warning, so keep it off from the start
+os.environ.setdefault('TOKENIZERS_PARALLELISM', 'false')
+with open(os.environ['API_CONFIG_PATH']) as JSON:
+    api_config = json.loads(JSON.read())
+
+bind = f"localhost:{api_config['port']}"
+workers = api_config['workers']
+worker_class = 'gthread'
+threads = api_config['worker_threads']
+# the model is loaded once in the master and its weights are shared copy-on-write by the forked workers
+preload_app = True
+# on SIGTERM workers stop accepting connections and get this long to finish in-flight requests
+graceful_timeout = api_config['graceful_timeout']
+# /metrics adds up the values of all workers through this directory, without it each worker reports its own
+metrics_dirpath = os.environ.get('METRICS_DIRPATH')
+
+
+def on_starting(server):
+    if metrics_dirpath:
+        from metrics import REGISTRY
+
+        # values of an earlier run are not carried over, the master's own (the preloaded FAQ set) are kept
+        shutil.rmtree(metrics_dirpath, ignore_errors=True)
+        REGISTRY.share(metrics_dirpath)
+
+
+def pre_fork(server, worker):
+    # objects created by the preloaded app are left out of garbage collection,
+    # otherwise collections in the workers write to their pages and unshare them
+    gc.freeze()
+
+
+def post_fork(server, worker):
+    import torch
+
+    torch_threads = api_config['torch_threads']
+    if torch_threads <= 0:
+        torch_threads = max(1, multiprocessing.cpu_count() // workers)
+    torch.set_num_threads(torch_threads)
+
+    if metrics_dirpath:
+        from metrics import REGISTRY
+
+        REGISTRY.reset()
+        REGISTRY.share(metrics_dirpath, api_config['metrics_write_interval'])
+
+
+def worker_exit(server, worker):
+    import api
+
+    if api.faq_service.loaded:
+        api.faq_service.sts.save_hashtag_segmentations()
+    api.REGISTRY.write()
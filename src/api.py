@@ -1,11 +1,16 @@
 import json
+import multiprocessing
 import os
+import threading
+import time
 
 from dotenv import load_dotenv, find_dotenv
-from flask import Flask, request, jsonify
+from flask import Flask, Response, g, request, jsonify
 from pyngrok import ngrok
 
 from data.firebase import FirebaseDBManager
+from faq_service import FAQService
+from metrics import REGISTRY, stage_timer
 
 app = Flask(__name__)
 load_dotenv(find_dotenv())
@@ -14,8 +19,74 @@ with open(os.environ['API_CONFIG_PATH']) as JSON:
     app.secret_key = app_config['secret_key']
 
 firebase_db = FirebaseDBManager()
-sts = None
-faq_data = None
+faq_service = FAQService(app_config['similarity_threshold'], app_config['batch_chunk_size'], firebase_db)
+
+# bumped by /update-faq-set, allocated before workers are forked so that every worker sees it
+# and starts reloading its own copy of the FAQ set on its next request
+faq_set_version = multiprocessing.Value('i', 0)
+loaded_faq_set_version = 0
+faq_set_lock = threading.Lock()
+
+serialize_timer = stage_timer('serialize')
+faq_set_load_timer = REGISTRY.histogram('faq_set_load_seconds', 'Time spent loading or updating the FAQ set')
+
+
+def load_faq_set(version):
+    global loaded_faq_set_version
+    with faq_set_load_timer.time():
+        faq_service.load_faq_set()
+    loaded_faq_set_version = version
+
+
+def create_app():
+    # loads the FAQ set and the model, under gunicorn this runs once in the master before forking
+    with faq_set_lock:
+        if not faq_service.loaded:
+            load_faq_set(faq_set_version.value)
+    return app
+
+
+@app.before_request
+def start_request_timer():
+    g.request_start = time.perf_counter()
+
+
+@app.after_request
+def record_request(response):
+    # streamed responses are timed until their first byte
+    endpoint = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+    if 'request_start' in g:
+        REGISTRY.histogram('api_request_seconds', 'Time from receiving a request to sending its response',
+                           endpoint=endpoint).observe(time.perf_counter() - g.request_start)
+    REGISTRY.counter('api_requests_total', 'Requests served, by endpoint and status code',
+                     endpoint=endpoint, status=response.status_code).inc()
+    return response
+
+
+def reload_faq_set():
+    # runs on its own thread, holding the faq_set_lock taken by sync_faq_set
+    try:
+        version = faq_set_version.value
+        if version != loaded_faq_set_version:
+            load_faq_set(version)
+    except Exception:
+        # the current FAQ set stays in use, a later request starts another reload
+        app.logger.exception('Reloading the FAQ set failed')
+    finally:
+        faq_set_lock.release()
+
+
+@app.before_request
+def sync_faq_set():
+    # the first request to see a new version starts a reload in the background, it and every other request
+    # are answered from the current FAQ set until the new one is swapped in
+    if faq_service.loaded and faq_set_version.value != loaded_faq_set_version \
+            and faq_set_lock.acquire(blocking=False):
+        try:
+            threading.Thread(target=reload_faq_set, daemon=True).start()
+        except BaseException:
+            faq_set_lock.release()
+            raise
 
 
 @app.route('/')
@@ -29,7 +100,7 @@ def all_faq():
     assert 'secret_key' in data
     if data['secret_key'] != app.secret_key:
         return jsonify({"message": "Wrong secret key"}), 401
-    return jsonify(faq_data.to_dict(orient='records'))
+    return jsonify(faq_service.all_faqs().to_dict(orient='records'))
 
 
 @app.route('/faq', methods=['GET'])
@@ -39,7 +110,7 @@ def get_faq():
     if data['secret_key'] != app.secret_key:
         return jsonify({"message": "Wrong secret key"}), 401
     assert 'question' in data
-    faq = firebase_db.get_faq_by_question(data['question'])
+    faq = faq_service.get_faq(data['question'])
     if faq:
         return jsonify(faq)
     return jsonify({"message": "FAQ not found"}), 404
@@ -51,8 +122,11 @@ def update_faq_set():
     assert 'secret_key' in data
     if data['secret_key'] != app.secret_key:
         return jsonify({"message": "Wrong secret key"}), 401
-    global faq_data
-    faq_data = firebase_db.get_all_faqs()
+    with faq_set_version.get_lock():
+        faq_set_version.value += 1
+        version = faq_set_version.value
+    with faq_set_lock:
+        load_faq_set(version)
     return jsonify({"message": "FAQ set updated"})
 
 
@@ -64,17 +138,11 @@ def nearest_faq():
         return jsonify({"message": "Wrong secret key"}), 401
     assert 'question' in data
 
-    result = firebase_db.get_faq_by_question(data['question'].strip())
-    if not result:
-        index, score = sts.get_stored_best_match(data['question'], return_indices=True)
-        if score < app_config['similarity_threshold']:
-            return jsonify({"message": "Related FAQ not found"}), 404
-        result = faq_data.iloc[index]
-        result['score'] = score
-        result = result.to_dict()
-    else:
-        result['score'] = 1
-    return jsonify({"nearest-faq": result})
+    result = faq_service.nearest_faq(data['question'])
+    if result is None:
+        return jsonify({"message": "Related FAQ not found"}), 404
+    with serialize_timer.time():
+        return jsonify({"nearest-faq": result})
 
 
 @app.route('/n-nearest-faqs', methods=['GET'])
@@ -84,17 +152,34 @@ def n_nearest_faq():
     if data['secret_key'] != app.secret_key:
         return jsonify({"message": "Wrong secret key"}), 401
     assert 'question' in data and 'n-returns' in data
-    indices, scores = sts.get_stored_best_matches(data['question'],
-                                                  nbest=int(data['n-returns']),
-                                                  return_indices=True)
-    if firebase_db.get_faq_by_question(data['question'].strip()):
-        scores[0] = 1
-    if scores[0] < app_config['similarity_threshold']:
+    result = faq_service.n_nearest_faqs(data['question'], int(data['n-returns']))
+    if result is None:
         return jsonify({"message": "Related FAQs not found"}), 404
-    result = faq_data.iloc[indices]
-    result.loc[:, 'score'] = scores
-    result = result.to_dict(orient='records')
-    return jsonify({"n-nearest-faqs": result})
+    with serialize_timer.time():
+        return jsonify({"n-nearest-faqs": result})
+
+
+def batch_nearest_faqs(questions, n_returns):
+    for question, result in faq_service.batch_nearest_faqs(questions, n_returns):
+        if result is None:
+            yield {"question": question, "message": "Related FAQs not found"}
+        else:
+            yield {"question": question, "n-nearest-faqs": result}
+
+
+@app.route('/batch-nearest-faqs', methods=['POST'])
+def batch_nearest_faq():
+    data = request.get_json(force=True)
+    assert 'secret_key' in data
+    if data['secret_key'] != app.secret_key:
+        return jsonify({"message": "Wrong secret key"}), 401
+    assert 'questions' in data and 'n-returns' in data
+    assert isinstance(data['questions'], list) and all(isinstance(q, str) for q in data['questions'])
+    results = batch_nearest_faqs(data['questions'], int(data['n-returns']))
+    if data.get('stream', False):
+        # one JSON object per line, sent as soon as its chunk is scored
+        return Response((json.dumps(result) + '\n' for result in results), mimetype='application/x-ndjson')
+    return jsonify({"batch-nearest-faqs": list(results)})
 
 
 @app.route('/send-feedback', methods=['POST'])
@@ -104,18 +189,24 @@ def send_feedback():
     if data['secret_key'] != app.secret_key:
         return jsonify({"message": "Wrong secret key"}), 401
     assert 'feedback' in data
-    firebase_db.push_feedback(data['feedback'])
+    faq_service.send_feedback(data['feedback'])
     return jsonify({"message": "Feedback sent"})
 
 
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    # Prometheus text format, for a scrape config with params: {secret_key: [...]}
+    data = request.args.to_dict()
+    assert 'secret_key' in data
+    if data['secret_key'] != app.secret_key:
+        return jsonify({"message": "Wrong secret key"}), 401
+    return Response(REGISTRY.render(), mimetype='text/plain; version=0.0.4')
+
+
 if __name__ == '__main__':
-    faq_data = firebase_db.get_all_faqs()
     if app_config['run_with_ngrok']:
         ngrok.set_auth_token(app_config['ngrok_auth_token'])
         http_tunnel = ngrok.connect(app_config['port'])
         print(http_tunnel)
         firebase_db.set_main_api_connection(http_tunnel.public_url, app_config['secret_key'])
-    from sts import SemanticTextualSimilarityPipeline
-
-    sts = SemanticTextualSimilarityPipeline(stored_texts=faq_data.question)
-    app.run(host='localhost', port=app_config['port'])
+    create_app().run(host='localhost', port=app_config['port'])
@@ -0,0 +1,36 @@
+import pandas as pd
+
+from data.firebase import FirebaseDBManager
+
+
+class FAQCache:
+
+    def __init__(self, firebase_db: FirebaseDBManager):
+        self._firebase_db = firebase_db
+        # (FAQ data, normalized question -> record), always replaced as a whole
+        self._state = (None, dict())
+
+    @staticmethod
+    def normalize_question(question: str) -> str:
+        return ' '.join(question.split())
+
+    @property
+    def faqs(self) -> pd.DataFrame:
+        return self._state[0]
+
+    def set_faqs(self, faq_data: pd.DataFrame):
+        lookup = dict()
+        for record in faq_data.to_dict(orient='records'):
+            lookup.setdefault(FAQCache.normalize_question(record['question']), record)
+        self._state = (faq_data, lookup)
+
+    def refresh(self) -> pd.DataFrame:
+        faq_data = self._firebase_db.get_all_faqs()
+        self.set_faqs(faq_data)
+        return faq_data
+
+    def get_faq_by_question(self, question: str) -> dict:
+        record = self._state[1].get(FAQCache.normalize_question(question))
+        if record is None:
+            return dict()
+        return dict(record)
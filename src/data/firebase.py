@@ -1,5 +1,6 @@
 import json
 import os
+from collections import defaultdict
 
 import numpy as np
 import pandas as pd
@@ -34,6 +35,44 @@ class FirebaseDBManager:
     def clear_all_faqs(self):
         self._db.child('FAQ').remove()
 
+    def sync_faqs(self, faqs, dry_run=False) -> dict:
+        # FAQs are matched to the stored ones by question, and only the differences are written,
+        # in a single multi-path update, so readers never see an empty or half-written FAQ node
+        faqs = list(faqs)
+        for faq in faqs:
+            assert 'question' in faq and isinstance(faq['question'], str)
+            assert 'answer' in faq and isinstance(faq['answer'], str)
+        stored = defaultdict(list)
+        for key, record in (self._db.child('FAQ').get().val() or dict()).items():
+            stored[record.get('question')].append((key, record))
+
+        changes = {
+            'inserted': [],
+            'updated': [],
+            'deleted': [],
+            'unchanged': 0
+        }
+        updates = dict()
+        for faq in faqs:
+            if stored[faq['question']]:
+                key, record = stored[faq['question']].pop(0)
+                if record == faq:
+                    changes['unchanged'] += 1
+                    continue
+                changes['updated'].append(faq['question'])
+            else:
+                key = self._db.generate_key()
+                changes['inserted'].append(faq['question'])
+            updates[key] = faq
+        for question, records in stored.items():
+            for key, _ in records:
+                changes['deleted'].append(question)
+                updates[key] = None
+
+        if updates and not dry_run:
+            self._db.child('FAQ').update(updates)
+        return changes
+
     def get_all_faqs(self) -> pd.DataFrame:
         records = list(self._db.child('FAQ').get().val().items())
         return pd.DataFrame([r[1] for r in records])
@@ -0,0 +1,101 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+class UserCache:
+    """
+    Per-user key-value cache for the Telegram bot: entries are keyed by (user, namespace, key), so users
+    never see each other's data. The least recently used entry is evicted when a user holds more than
+    max_per_user entries or the whole cache holds more than maxsize, and entries expire after ttl seconds.
+    """
+
+    def __init__(self, maxsize=100000, max_per_user=200, ttl=None):
+        assert maxsize > 0 and max_per_user > 0
+        self.maxsize = maxsize
+        self.max_per_user = max_per_user
+        self.ttl = ttl
+        # (user, namespace, key) -> (expires_at, value), least recently used first
+        self._data = OrderedDict()
+        # user -> that user's keys, least recently used first
+        self._user_keys = dict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def __len__(self):
+        return len(self._data)
+
+    def _remove(self, full_key):
+        self._data.pop(full_key, None)
+        user_keys = self._user_keys.get(full_key[0])
+        if user_keys is not None:
+            user_keys.pop(full_key, None)
+            if not user_keys:
+                del self._user_keys[full_key[0]]
+
+    def _lookup(self, full_key):
+        item = self._data.get(full_key)
+        if item is not None and self.ttl is not None and item[0] < time.monotonic():
+            self._remove(full_key)
+            self.expirations += 1
+            item = None
+        if item is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return item
+
+    def get(self, user, namespace, key, default=None):
+        full_key = (user, namespace, key)
+        with self._lock:
+            item = self._lookup(full_key)
+            if item is None:
+                return default
+            self._data.move_to_end(full_key)
+            self._user_keys[user].move_to_end(full_key)
+            return item[1]
+
+    def pop(self, user, namespace, key, default=None):
+        full_key = (user, namespace, key)
+        with self._lock:
+            item = self._lookup(full_key)
+            if item is None:
+                return default
+            self._remove(full_key)
+            return item[1]
+
+    def put(self, user, namespace, key, value):
+        full_key = (user, namespace, key)
+        expires_at = time.monotonic() + self.ttl if self.ttl is not None else None
+        with self._lock:
+            self._data[full_key] = (expires_at, value)
+            self._data.move_to_end(full_key)
+            user_keys = self._user_keys.setdefault(user, OrderedDict())
+            user_keys[full_key] = None
+            user_keys.move_to_end(full_key)
+            while len(user_keys) > self.max_per_user:
+                self._remove(next(iter(user_keys)))
+                self.evictions += 1
+            while len(self._data) > self.maxsize:
+                self._remove(next(iter(self._data)))
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._user_keys.clear()
+
+    def stats(self) -> dict:
+        return {
+            'size': len(self._data),
+            'users': len(self._user_keys),
+            'maxsize': self.maxsize,
+            'max_per_user': self.max_per_user,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'expirations': self.expirations
+        }
@@ -1,52 +1,135 @@
+import hashlib
 import json
 import os
 import re
+from concurrent.futures import ThreadPoolExecutor
 from typing import List
 
 import pandas as pd
 import requests
 from bs4 import BeautifulSoup
 from dotenv import load_dotenv, find_dotenv
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 
 class WHOFAQCrawler:
+    # single spaces are left alone, only runs and tabs / line breaks need rewriting
+    _whitespace_regex = re.compile(r'[ \t\n]{2,}|[\t\n]')
+    _punctuations = frozenset('.,!?;:"\')(')
+
     @staticmethod
-    def default_source_urls():
+    def crawler_config():
         load_dotenv(find_dotenv())
         with open(os.environ['WHO_FAQ_URLS_PATH']) as JSON:
-            return json.loads(JSON.read())['source_urls']
+            return json.loads(JSON.read())
+
+    @staticmethod
+    def default_source_urls():
+        return WHOFAQCrawler.crawler_config()['source_urls']
+
+    @staticmethod
+    def default_cache_dirpath():
+        load_dotenv(find_dotenv())
+        return os.environ.get('WHO_CACHE_DIRPATH')
+
+    @staticmethod
+    def session(pool_size=10, retries=3, backoff_factor=0.5) -> requests.Session:
+        # one keep-alive pool shared by every crawling thread, transient server errors are retried with backoff
+        retry = Retry(total=retries, backoff_factor=backoff_factor, status_forcelist=[429, 500, 502, 503, 504])
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+        session = requests.Session()
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        return session
+
+    @staticmethod
+    def _cache_path(cache_dirpath, url):
+        return os.path.join(cache_dirpath, hashlib.sha1(url.encode('utf-8')).hexdigest() + '.json')
+
+    @staticmethod
+    def fetch(url: str, session: requests.Session = None, timeout=None, cache_dirpath=None) -> str:
+        # with a cache directory, pages are revalidated with their ETag / Last-Modified
+        # and an unchanged page (304) is served from disk instead of being downloaded again
+        session = session if session is not None else requests
+        cached = None
+        headers = dict()
+        if cache_dirpath is not None:
+            cache_path = WHOFAQCrawler._cache_path(cache_dirpath, url)
+            if os.path.exists(cache_path):
+                with open(cache_path) as JSON:
+                    cached = json.loads(JSON.read())
+                if cached.get('etag'):
+                    headers['If-None-Match'] = cached['etag']
+                if cached.get('last_modified'):
+                    headers['If-Modified-Since'] = cached['last_modified']
+
+        response = session.get(url, headers=headers, timeout=timeout)
+        if response.status_code == 304 and cached is not None:
+            return cached['text']
+        response.raise_for_status()
+
+        if cache_dirpath is not None and ('ETag' in response.headers or 'Last-Modified' in response.headers):
+            os.makedirs(cache_dirpath, exist_ok=True)
+            tmp_path = cache_path + '.tmp'
+            with open(tmp_path, 'w') as JSON:
+                JSON.write(json.dumps({
+                    'url': url,
+                    'etag': response.headers.get('ETag'),
+                    'last_modified': response.headers.get('Last-Modified'),
+                    'text': response.text
+                }))
+            os.replace(tmp_path, cache_path)
+        return response.text
+
+    @staticmethod
+    def _clean_whitespace(match) -> str:
+        # a run of spaces becomes one space and a run containing a line break becomes one line break,
+        # which is dropped when punctuation follows so that it sticks to the preceding word
+        whitespace = match.group()
+        if '\n' not in whitespace:
+            return ' '
+        end = match.end()
+        if end < len(match.string) and match.string[end] in WHOFAQCrawler._punctuations:
+            return ''
+        return '\n'
 
     @staticmethod
     def preprocess(text: str) -> str:
-        punctuations = ['.', ',', '!', '?', ';', ':', '\"', '\'', ')', '(']
-        for p in punctuations:
-            text = text.replace(f'\n{p}', p)
-            text = re.sub(r'\t', ' ', text)
-            text = re.sub(r' {2}', ' ', text)
-            text = re.sub(r'\n\n', '\n', text)
-            text = re.sub(r'\n ', '\n', text)
-            text = re.sub(r' \n', '\n', text)
-        return text
-
-    @staticmethod
-    def crawl_qas(url: str) -> (List, List):
-        response = requests.get(url)
-        txt = response.text
+        return WHOFAQCrawler._whitespace_regex.sub(WHOFAQCrawler._clean_whitespace, text)
+
+    @staticmethod
+    def crawl_qas(url: str, session: requests.Session = None, timeout=None, cache_dirpath=None) -> (List, List):
+        txt = WHOFAQCrawler.fetch(url, session=session, timeout=timeout, cache_dirpath=cache_dirpath)
         soup = BeautifulSoup(txt, 'html.parser')
         questions = soup.find_all("a", class_="sf-accordion__link")
         answers = soup.find_all("p", class_="sf-accordion__summary")
         return questions, answers
 
     @staticmethod
-    def faq_dataset(source_urls: List = None) -> pd.DataFrame:
+    def faq_dataset(source_urls: List = None, cache_dirpath=None) -> pd.DataFrame:
+        config = WHOFAQCrawler.crawler_config()
         if not source_urls:
-            source_urls = WHOFAQCrawler.default_source_urls()
+            source_urls = config['source_urls']
+        if cache_dirpath is None:
+            cache_dirpath = WHOFAQCrawler.default_cache_dirpath()
+        max_workers = config['max_workers']
+        assert max_workers > 0
         qa_data = {
             "question": [],
             "answer": []
         }
-        for url in source_urls:
-            questions, answers = WHOFAQCrawler.crawl_qas(url)
+        with WHOFAQCrawler.session(pool_size=max_workers,
+                                   retries=config['retries'],
+                                   backoff_factor=config['backoff_factor']) as session, \
+                ThreadPoolExecutor(max_workers=max_workers) as executor:
+            # map keeps the order of source_urls, so the dataset is the same as a sequential crawl
+            crawled = list(executor.map(lambda url: WHOFAQCrawler.crawl_qas(url,
+                                                                            session=session,
+                                                                            timeout=config['timeout'],
+                                                                            cache_dirpath=cache_dirpath),
+                                        source_urls))
+        for questions, answers in crawled:
             assert len(questions) == len(answers)
             qa_data['question'] += questions
             qa_data['answer'] += answers
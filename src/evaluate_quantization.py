@@ -0,0 +1,75 @@
+import argparse
+import json
+import os
+import random
+
+import numpy as np
+import pandas as pd
+
+from data.who import WHOFAQCrawler
+from sts import SemanticTextualSimilarityPipeline
+
+
+def drop_one_word(question, rng):
+    # a near paraphrase of the FAQ question, so that top-1 is not a trivial exact match
+    words = question.split()
+    if len(words) > 3:
+        del words[rng.randrange(len(words))]
+    return ' '.join(words)
+
+
+def score_summary(scores, threshold):
+    return 'mean {:.4f}, p5 {:.4f}, p50 {:.4f}, p95 {:.4f}, above threshold {:.1%}'.format(
+        scores.mean(), *np.percentile(scores, [5, 50, 95]), np.mean(scores >= threshold))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--config-dirpath', default=None, type=str)
+    parser.add_argument('--faqs-path',
+                        default=None,
+                        type=str,
+                        help='CSV with question and answer columns, the WHO FAQ set is crawled by default')
+    parser.add_argument('--queries-path',
+                        default=None,
+                        type=str,
+                        help='questions to match, one per line, FAQ questions with one word dropped by default')
+    parser.add_argument('--threshold',
+                        default=None,
+                        type=float,
+                        help='similarity_threshold of the main API config by default')
+    parser.add_argument('--random-state', default=108, type=int)
+    args = parser.parse_args()
+
+    faq_data = pd.read_csv(args.faqs_path) if args.faqs_path else WHOFAQCrawler.faq_dataset()
+    faq_data = faq_data.reset_index(drop=True)
+    if args.queries_path:
+        with open(args.queries_path) as f:
+            queries = [line.strip() for line in f if line.strip()]
+    else:
+        rng = random.Random(args.random_state)
+        queries = [drop_one_word(question, rng) for question in faq_data.question]
+
+    top1 = dict()
+    for quantization in ['none', 'dynamic-int8']:
+        sts = SemanticTextualSimilarityPipeline(config_dirpath=args.config_dirpath,
+                                                stored_texts=faq_data.question,
+                                                stored_data=faq_data,
+                                                quantization=quantization)
+        indices, scores = sts.get_stored_best_matches_batch(queries, nbest=1, return_indices=True)
+        top1[quantization] = (indices[:, 0], scores[:, 0])
+        del sts
+
+    threshold = args.threshold
+    if threshold is None:
+        with open(os.environ['API_CONFIG_PATH']) as JSON:
+            threshold = json.loads(JSON.read())['similarity_threshold']
+    (fp32_indices, fp32_scores), (int8_indices, int8_scores) = top1['none'], top1['dynamic-int8']
+    print(f'{len(queries)} queries against {len(faq_data)} FAQs, threshold {threshold}')
+    print(f'top-1 agreement: {np.mean(fp32_indices == int8_indices):.1%}')
+    print(f'fp32 top-1 scores: {score_summary(fp32_scores, threshold)}')
+    print(f'int8 top-1 scores: {score_summary(int8_scores, threshold)}')
+    print('score shift (int8 - fp32): mean {:+.4f}, max abs {:.4f}'.format(
+        np.mean(int8_scores - fp32_scores), np.max(np.abs(int8_scores - fp32_scores))))
+    print('threshold decisions flipped: {} of {}'.format(
+        int(np.sum((fp32_scores >= threshold) != (int8_scores >= threshold))), len(queries)))
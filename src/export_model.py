@@ -0,0 +1,51 @@
+import argparse
+
+import numpy as np
+
+from sts import SemanticTextualSimilarityPipeline
+from sts.utils.backend import EXPORT_BACKENDS
+
+SAMPLE_TEXTS = [
+    "What is COVID-19?",
+    "How does the coronavirus spread between people?",
+    "Should children wear masks at school?",
+    "Are COVID-19 vaccines safe for people living with HIV?",
+    "Can I get vaccinated if I already had covid?",
+    "What are the symptoms of the omicron variant",
+    "is it safe for older people to travel during the pandemic??",
+    "#StayHome how long should I quarantine after a positive test @WHO",
+    "Do I need a booster dose",
+    "How long does immunity last after infection and after vaccination, and is it different for elderly people?"
+]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--backend',
+                        default='torchscript',
+                        choices=list(EXPORT_BACKENDS),
+                        type=str)
+    parser.add_argument('--config-dirpath', default=None, type=str)
+    parser.add_argument('--texts-path',
+                        default=None,
+                        type=str,
+                        help='questions to check the exported model on, one per line')
+    parser.add_argument('--max-cosine-drift', default=1e-4, type=float)
+    args = parser.parse_args()
+
+    texts = SAMPLE_TEXTS
+    if args.texts_path is not None:
+        with open(args.texts_path) as f:
+            texts = [line.strip() for line in f if line.strip()]
+
+    eager = SemanticTextualSimilarityPipeline(config_dirpath=args.config_dirpath, inference_backend='pytorch')
+    path = eager.export_inference_model(args.backend, texts[:2])
+    print(f'exported to {path}')
+
+    exported = SemanticTextualSimilarityPipeline(config_dirpath=args.config_dirpath, inference_backend=args.backend)
+    eager_embeddings = eager.embed_queries(texts)
+    exported_embeddings = exported.embed_queries(texts)
+    drift = 1 - np.sum(eager_embeddings * exported_embeddings, axis=1) / (
+            np.linalg.norm(eager_embeddings, axis=1) * np.linalg.norm(exported_embeddings, axis=1))
+    print(f'cosine drift on {len(texts)} texts: max {drift.max():.2e}, mean {drift.mean():.2e}')
+    assert drift.max() <= args.max_cosine_drift, 'exported model drifts too far from the eager model'
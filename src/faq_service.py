@@ -0,0 +1,128 @@
+import pandas as pd
+import requests
+from requests.adapters import HTTPAdapter
+
+from data.faq_cache import FAQCache
+from data.firebase import FirebaseDBManager
+from metrics import REGISTRY, stage_timer
+
+faq_lookup_timer = stage_timer('faq_lookup')
+to_dict_timer = stage_timer('to_dict')
+# data.firebase stays free of metrics, it is also imported by update_faqs.py from the repo root
+get_all_faqs_timer = REGISTRY.histogram('firebase_call_seconds', 'Firebase calls made while serving, by method',
+                                        method='get_all_faqs')
+push_feedback_timer = REGISTRY.histogram('firebase_call_seconds', 'Firebase calls made while serving, by method',
+                                         method='push_feedback')
+exact_matches = REGISTRY.counter('faq_exact_matches_total', 'Questions answered by an exact FAQ match')
+
+
+class FAQService:
+    """
+    FAQ lookups, similarity search and feedback, shared by the Flask routes and by the Telegram bot
+    when it runs the model in-process. The STS pipeline is only imported by load_faq_set, so users
+    of this module that never load the FAQ set do not pull in torch.
+    """
+
+    def __init__(self, similarity_threshold, batch_chunk_size=256, firebase_db: FirebaseDBManager = None):
+        self.similarity_threshold = similarity_threshold
+        self.batch_chunk_size = batch_chunk_size
+        self._firebase_db = firebase_db if firebase_db is not None else FirebaseDBManager()
+        self._faq_cache = FAQCache(self._firebase_db)
+        self.sts = None
+
+    @property
+    def loaded(self) -> bool:
+        return self.sts is not None
+
+    def load_faq_set(self):
+        with get_all_faqs_timer.time():
+            faq_data = self._firebase_db.get_all_faqs()
+        if self.sts is None:
+            from sts import SemanticTextualSimilarityPipeline
+
+            self.sts = SemanticTextualSimilarityPipeline(stored_texts=faq_data.question, stored_data=faq_data)
+        else:
+            self.sts.update_stored_texts(faq_data.question, stored_data=faq_data)
+        # exact matches and /all-faq only move to the new set once its index is in place,
+        # a failed reload leaves both on the previous one
+        self._faq_cache.set_faqs(faq_data)
+
+    def all_faqs(self) -> pd.DataFrame:
+        return self._faq_cache.faqs
+
+    def get_faq(self, question: str) -> dict:
+        return self._faq_cache.get_faq_by_question(question)
+
+    def _exact_match(self, question: str) -> dict:
+        with faq_lookup_timer.time():
+            result = self._faq_cache.get_faq_by_question(question)
+        if result:
+            exact_matches.inc()
+        return result
+
+    def nearest_faq(self, question: str):
+        result = self._exact_match(question)
+        if result:
+            result['score'] = 1
+            return result
+        result = self.sts.get_stored_best_records(question, nbest=1).iloc[0]
+        if result['score'] < self.similarity_threshold:
+            return None
+        with to_dict_timer.time():
+            return result.to_dict()
+
+    def _related_records(self, question: str, records: pd.DataFrame):
+        if self._exact_match(question):
+            records.iloc[0, records.columns.get_loc('score')] = 1
+        if records['score'].iloc[0] < self.similarity_threshold:
+            return None
+        with to_dict_timer.time():
+            return records.to_dict(orient='records')
+
+    def n_nearest_faqs(self, question: str, n_returns):
+        return self._related_records(question, self.sts.get_stored_best_records(question, nbest=n_returns))
+
+    def batch_nearest_faqs(self, questions, n_returns):
+        # questions are embedded and searched a chunk at a time, results keep the input order
+        for start in range(0, len(questions), self.batch_chunk_size):
+            chunk = questions[start:start + self.batch_chunk_size]
+            for question, records in zip(chunk, self.sts.get_stored_best_records_batch(chunk, nbest=n_returns)):
+                yield question, self._related_records(question, records)
+
+    def send_feedback(self, feedback: dict):
+        with push_feedback_timer.time():
+            self._firebase_db.push_feedback(feedback)
+
+
+class MainAPIClient:
+    """
+    The FAQService calls the Telegram bot makes, over HTTP to a main API running elsewhere: one keep-alive
+    connection pool shared by all handler threads, failed requests raise requests.RequestException.
+    """
+
+    def __init__(self, url, secret_key, pool_size=10, timeout=None):
+        self.url = url
+        self._secret_key = secret_key
+        self._timeout = timeout
+        self._session = requests.Session()
+        self._session.mount('http://', HTTPAdapter(pool_connections=1, pool_maxsize=pool_size))
+        self._session.mount('https://', HTTPAdapter(pool_connections=1, pool_maxsize=pool_size))
+
+    def check_connection(self) -> bool:
+        r = self._session.get(self.url + '/', params={'secret_key': self._secret_key}, timeout=self._timeout)
+        return r.status_code == 200
+
+    def n_nearest_faqs(self, question: str, n_returns):
+        r = self._session.get(self.url + '/n-nearest-faqs',
+                              params={'question': question, 'n-returns': n_returns, 'secret_key': self._secret_key},
+                              timeout=self._timeout)
+        if r.status_code == 404:
+            return None
+        r.raise_for_status()
+        return r.json()['n-nearest-faqs']
+
+    def send_feedback(self, feedback: dict):
+        r = self._session.post(self.url + '/send-feedback',
+                               json={'secret_key': self._secret_key, 'feedback': feedback},
+                               timeout=self._timeout)
+        r.raise_for_status()
@@ -0,0 +1,254 @@
+import bisect
+import json
+import os
+import tempfile
+import threading
+import time
+import weakref
+from contextlib import contextmanager
+
+# seconds, from a cache hit to a large batch forward pass on CPU
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0,
+                   2.5, 5.0, 10.0)
+SIZE_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128, 256, 512)
+
+
+def _format_labels(labels: dict) -> str:
+    if not labels:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                          for name, value in labels.items()) + '}'
+
+
+def _format_value(value) -> str:
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    def __init__(self, labels: dict):
+        self.labels = labels
+        self._lock = threading.Lock()
+        self.value = 0
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+    def set(self, value):
+        # for counts kept elsewhere and copied in by a collector
+        with self._lock:
+            self.value = value
+
+    def state(self):
+        return self.value
+
+    def reset(self):
+        with self._lock:
+            self.value = 0
+
+    @staticmethod
+    def merge(states):
+        return sum(states)
+
+    @staticmethod
+    def samples(state, name, labels):
+        yield name, labels, state
+
+
+class Gauge(Counter):
+    pass
+
+
+class Histogram:
+    def __init__(self, labels: dict, buckets=LATENCY_BUCKETS):
+        assert list(buckets) == sorted(buckets)
+        self.labels = labels
+        self.buckets = tuple(buckets)
+        self._lock = threading.Lock()
+        # one count per bucket, the last one for values above every bound
+        self._counts = [0] * (len(self.buckets) + 1)
+        self._sum = 0.0
+
+    def observe(self, value):
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self._counts[i] += 1
+            self._sum += value
+
+    @contextmanager
+    def time(self):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start)
+
+    def state(self):
+        with self._lock:
+            return {'buckets': list(self.buckets), 'counts': list(self._counts), 'sum': self._sum}
+
+    def reset(self):
+        with self._lock:
+            self._counts = [0] * (len(self.buckets) + 1)
+            self._sum = 0.0
+
+    @staticmethod
+    def merge(states):
+        states = list(states)
+        assert all(state['buckets'] == states[0]['buckets'] for state in states)
+        return {'buckets': states[0]['buckets'],
+                'counts': [sum(counts) for counts in zip(*[state['counts'] for state in states])],
+                'sum': sum(state['sum'] for state in states)}
+
+    @staticmethod
+    def samples(state, name, labels):
+        cumulative = 0
+        total = state['sum']
+        for bound, count in zip([repr(float(bound)) for bound in state['buckets']] + ['+Inf'], state['counts']):
+            cumulative += count
+            yield name + '_bucket', dict(labels, le=bound), cumulative
+        yield name + '_sum', labels, total
+        yield name + '_count', labels, cumulative
+
+
+class MetricsRegistry:
+    """
+    Counters and histograms in the Prometheus text format, without the client library. Each metric is
+    created once by name and labels and then updated under its own lock, so recording costs a dict
+    lookup and a lock round trip. Every process keeps its own values. Once shared through a directory,
+    each process writes its values there as <pid>.json and render adds up the files of all of them,
+    otherwise render reports this process's values labelled with its pid.
+    """
+
+    metric_classes = {'counter': Counter, 'gauge': Gauge, 'histogram': Histogram}
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # name -> (type, help, labels tuple -> metric)
+        self._families = dict()
+        self._collectors = []
+        self._dirpath = None
+
+    def _get(self, metric_class, metric_type, name, documentation, labels, **kwargs):
+        key = tuple(sorted(labels.items()))
+        family = self._families.get(name)
+        metric = family[2].get(key) if family is not None else None
+        if metric is None:
+            with self._lock:
+                family = self._families.setdefault(name, (metric_type, documentation, dict()))
+                assert family[0] == metric_type
+                metric = family[2].setdefault(key, metric_class(labels, **kwargs))
+        return metric
+
+    def counter(self, name, documentation, **labels) -> Counter:
+        assert name.endswith('_total')
+        return self._get(Counter, 'counter', name, documentation, labels)
+
+    def gauge(self, name, documentation, **labels) -> Gauge:
+        return self._get(Gauge, 'gauge', name, documentation, labels)
+
+    def histogram(self, name, documentation, buckets=LATENCY_BUCKETS, **labels) -> Histogram:
+        return self._get(Histogram, 'histogram', name, documentation, labels, buckets=buckets)
+
+    def add_collector(self, collect):
+        # a bound method, called before every snapshot to copy values kept elsewhere into metrics.
+        # It is held weakly and dropped with its object.
+        with self._lock:
+            self._collectors.append(weakref.WeakMethod(collect))
+
+    def _collect(self):
+        with self._lock:
+            collectors = [collector() for collector in self._collectors]
+            self._collectors = [collector for collector, collect in zip(self._collectors, collectors)
+                                if collect is not None]
+        for collect in collectors:
+            if collect is not None:
+                collect()
+
+    def _metrics(self):
+        with self._lock:
+            return [(name, family[0], family[1], list(family[2].values())) for name, family in self._families.items()]
+
+    def snapshot(self) -> dict:
+        self._collect()
+        return {name: {'type': metric_type,
+                       'help': documentation,
+                       'metrics': [{'labels': metric.labels, 'state': metric.state()} for metric in metrics]}
+                for name, metric_type, documentation, metrics in self._metrics()}
+
+    def reset(self):
+        # a forked worker starts from zero, what it inherited is already counted in the master's file
+        for _, _, _, metrics in self._metrics():
+            for metric in metrics:
+                metric.reset()
+
+    def write(self):
+        if self._dirpath is None:
+            return
+        fd, tmp_path = tempfile.mkstemp(dir=self._dirpath, prefix='.tmp.')
+        try:
+            with os.fdopen(fd, 'w') as JSON:
+                JSON.write(json.dumps(self.snapshot()))
+            os.replace(tmp_path, os.path.join(self._dirpath, f'{os.getpid()}.json'))
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+
+    def _write_every(self, interval):
+        while True:
+            time.sleep(interval)
+            self.write()
+
+    def share(self, dirpath, interval=None):
+        # every interval seconds this process rewrites its file, so a scrape sees the other processes'
+        # values as of their last write. Files of exited processes stay and are still counted.
+        os.makedirs(dirpath, exist_ok=True)
+        self._dirpath = dirpath
+        self.write()
+        if interval is not None:
+            threading.Thread(target=self._write_every, args=(interval,), daemon=True).start()
+
+    def _snapshots(self):
+        if self._dirpath is None:
+            return [self.snapshot()]
+        self.write()
+        snapshots = []
+        for filename in os.listdir(self._dirpath):
+            if not filename.endswith('.json'):
+                continue
+            try:
+                with open(os.path.join(self._dirpath, filename)) as JSON:
+                    snapshots.append(json.loads(JSON.read()))
+            except FileNotFoundError:
+                continue
+        return snapshots
+
+    def render(self) -> str:
+        extra_labels = {'worker': str(os.getpid())} if self._dirpath is None else dict()
+        # name -> (type, help, labels tuple -> (labels, states))
+        families = dict()
+        for snapshot in self._snapshots():
+            for name, family in snapshot.items():
+                merged = families.setdefault(name, (family['type'], family['help'], dict()))
+                assert merged[0] == family['type']
+                for metric in family['metrics']:
+                    key = tuple(sorted((label, str(value)) for label, value in metric['labels'].items()))
+                    merged[2].setdefault(key, (metric['labels'], []))[1].append(metric['state'])
+
+        lines = []
+        for name, (metric_type, documentation, metrics) in sorted(families.items()):
+            metric_class = MetricsRegistry.metric_classes[metric_type]
+            lines.append(f'# HELP {name} {documentation}')
+            lines.append(f'# TYPE {name} {metric_type}')
+            for labels, states in metrics.values():
+                for sample_name, sample_labels, value in metric_class.samples(metric_class.merge(states), name,
+                                                                              dict(labels, **extra_labels)):
+                    lines.append(sample_name + _format_labels(sample_labels) + ' ' + _format_value(value))
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = MetricsRegistry()
+
+
+def stage_timer(stage) -> Histogram:
+    return REGISTRY.histogram('faq_stage_seconds', 'Time spent in each stage of answering a question', stage=stage)
@@ -1,19 +1,57 @@
 from sts.utils.preprocessor import TextPreprocessor
 from sts.utils.embedder import TransformersEmbedder
+from sts.utils.store import EmbeddingStore
+from sts.utils.index import ExactIndex, IVFIndex, top_k
+from sts.utils.cache import LRUCache
+from sts.utils.batcher import MicroBatcher
+from sts.utils.backend import EXPORT_BACKENDS, TextVectorModule
+from sts.utils.embedder import forward_timer
+from metrics import REGISTRY, SIZE_BUCKETS, stage_timer
 from transformers import AutoTokenizer, AutoModel, AutoConfig
 from sklearn.preprocessing import normalize
 from dotenv import load_dotenv, find_dotenv
+from collections import defaultdict, namedtuple
+import hashlib
 import json
+import logging
 import os
+import threading
 import pandas as pd
 import torch
 import random
 import numpy as np
 
 
+logger = logging.getLogger(__name__)
+
+# texts and data are aligned row by row, index entries are labelled and label_rows maps labels back to rows
+StoredSnapshot = namedtuple('StoredSnapshot', ['texts', 'data', 'hashes', 'index', 'row_labels', 'label_rows'])
+
+preprocess_timer = stage_timer('preprocess')
+search_timer = stage_timer('search')
+records_timer = stage_timer('records')
+forward_batch_sizes = REGISTRY.histogram('sts_forward_batch_size', 'Texts embedded per forward pass',
+                                         buckets=SIZE_BUCKETS)
+query_cache_hits = REGISTRY.counter('sts_query_cache_hits_total', 'Query embeddings found in the query cache')
+query_cache_misses = REGISTRY.counter('sts_query_cache_misses_total', 'Query embeddings missing from the query cache')
+# copied from the query cache and the micro-batcher whenever the metrics are collected
+query_cache_entries = REGISTRY.gauge('sts_query_cache_entries', 'Query embeddings held in the query cache')
+query_cache_evictions = REGISTRY.counter('sts_query_cache_evictions_total',
+                                         'Query embeddings evicted from the full query cache')
+query_cache_expirations = REGISTRY.counter('sts_query_cache_expirations_total',
+                                           'Query embeddings dropped from the query cache after their ttl')
+query_batches = REGISTRY.counter('sts_query_batches_total', 'Forward passes run by the query micro-batcher')
+query_batch_items = REGISTRY.counter('sts_query_batch_items_total', 'Queries embedded by the query micro-batcher')
+
+
 class SemanticTextualSimilarityPipeline:
 
-    def __init__(self, config_dirpath=None, stored_texts: pd.Series = None):
+    def __init__(self,
+                 config_dirpath=None,
+                 stored_texts: pd.Series = None,
+                 stored_data: pd.DataFrame = None,
+                 inference_backend=None,
+                 quantization=None):
         load_dotenv(find_dotenv())
         if config_dirpath is None:
             config_dirpath = os.environ['STS_CONFIG_DIRPATH']
@@ -44,72 +82,376 @@ class SemanticTextualSimilarityPipeline:
 
             self._model_config = AutoConfig.from_pretrained(selected_pretrained_model,
                                                             **json.loads(JSON.read()))
-            self._model = AutoModel.from_pretrained(selected_pretrained_model,
-                                                    config=self._model_config)
+            self._quantization = quantization or self._main_config['quantization']
+            assert self._quantization in ['none', 'dynamic-int8']
+            if self._quantization == 'dynamic-int8':
+                self._model = self._load_quantized_model(selected_pretrained_model)
+            else:
+                self._model = AutoModel.from_pretrained(selected_pretrained_model,
+                                                        config=self._model_config)
             self._model.to(self._device)
 
-        self.stored_texts = stored_texts
+        assert self._main_config['padding'] in ['max_length', 'dynamic']
+        self._dynamic_padding = self._main_config['padding'] == 'dynamic'
+        # last-layer-features are flattened token vectors, so they need a fixed length
+        assert not self._dynamic_padding or self._main_config['embedding_type'] == 'text-vector1d'
+
+        # everything an embedding depends on, used to key the cached embeddings
+        self._embedding_key = {
+            'model': selected_pretrained_model,
+            'embedding_type': self._main_config['embedding_type'],
+            'preprocessing': self._preprocessor_config,
+            'tokenizer': self._encode_config,
+            'padding': self._main_config['padding'],
+            'quantization': self._quantization
+        }
+        # text-vector1d can run on an exported graph (python src/export_model.py) instead of the eager model
+        self._inference_backend = inference_backend or self._main_config['inference_backend']
+        self._inference_model = None
+        if self._inference_backend != 'pytorch':
+            assert self._inference_backend in EXPORT_BACKENDS
+            assert self._main_config['embedding_type'] == 'text-vector1d'
+            # dynamically quantized linear layers have no ONNX export
+            assert self._quantization == 'none' or self._inference_backend != 'onnx'
+            exported_model_path = self.exported_model_path(self._inference_backend)
+            assert os.path.exists(exported_model_path), f'{exported_model_path} not found, export the model first'
+            self._inference_model = EXPORT_BACKENDS[self._inference_backend](exported_model_path, self._device)
+
+        self._embedding_store = None
+        if self._main_config['embedding_cache']:
+            # rows are stored normalized, so the memory-mapped file goes to the index as it is
+            self._embedding_store = EmbeddingStore(os.environ['EMBEDDING_CACHE_DIRPATH'],
+                                                   key=dict(self._embedding_key,
+                                                            embedding_norm=self._main_config['embedding_norm']))
+
+        # query embeddings keyed on the normalized text, owned by this pipeline so that
+        # a different model or preprocessing config always starts with an empty cache
+        self._query_cache = None
+        if self._main_config['query_cache_size'] > 0:
+            self._query_cache = LRUCache(maxsize=self._main_config['query_cache_size'],
+                                         ttl=self._main_config['query_cache_ttl'])
+
+        # hashtag segmentations survive restarts, so a warm start never loads the segmenter for known hashtags
+        self._hashtag_cache_path = os.environ.get('HASHTAG_CACHE_PATH')
+        if self._hashtag_cache_path:
+            TextPreprocessor.load_hashtag_segmentations(self._hashtag_cache_path)
+
+        # concurrent queries that miss the cache are embedded together in one forward pass
+        self._query_batcher = None
+        if self._main_config['micro_batch_size'] > 1:
+            self._query_batcher = MicroBatcher(lambda norm_texts: list(self._embed_norm_queries_now(norm_texts)),
+                                               max_batch_size=self._main_config['micro_batch_size'],
+                                               max_wait_ms=self._main_config['micro_batch_wait_ms'])
+        REGISTRY.add_collector(self._collect_metrics)
+
+        assert self._main_config['index_type'] in [ExactIndex.index_type, IVFIndex.index_type]
+
+        # always replaced as a whole, so readers never see a half-updated index
+        self._stored = StoredSnapshot(None, None, [], None, None, None)
+        self._stored_update_lock = threading.Lock()
         if stored_texts is not None:
-            self.stored_norm_text_embeddings = normalize(self._embed_series(stored_texts),
-                                                         norm=self._main_config['embedding_norm'])
+            self.set_stored_texts(stored_texts, stored_data=stored_data)
+
+    @property
+    def stored_texts(self) -> pd.Series:
+        return self._stored.texts
+
+    @property
+    def stored_data(self) -> pd.DataFrame:
+        return self._stored.data
+
+    @property
+    def stored_norm_text_embeddings(self) -> np.ndarray:
+        stored = self._stored
+        return stored.index.reconstruct(stored.row_labels)
+
+    def _load_quantized_model(self, pretrained_model_name):
+        # Linear weights are stored in int8 and activations are quantized on the fly, on CPU only.
+        # The quantized weights are cached, so later starts build the model from its config
+        # and never load the fp32 weights
+        assert self._device.type == 'cpu'
+        key = {
+            'model': pretrained_model_name,
+            'model_config': self._model_config.to_json_string(),
+            'quantization': self._quantization
+        }
+        key_digest = hashlib.sha1(json.dumps(key, sort_keys=True).encode('utf-8')).hexdigest()
+        path = os.path.join(os.environ['EXPORTED_MODEL_DIRPATH'], f'quantized.{key_digest[:16]}.pt')
+        if os.path.exists(path):
+            model = AutoModel.from_config(self._model_config).eval()
+            model = torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+            model.load_state_dict(torch.load(path))
+            return model
+        model = AutoModel.from_pretrained(pretrained_model_name, config=self._model_config).eval()
+        model = torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        torch.save(model.state_dict(), path + '.tmp')
+        os.replace(path + '.tmp', path)
+        return model
+
+    def exported_model_path(self, backend) -> str:
+        key = dict(self._embedding_key, backend=backend)
+        key_digest = hashlib.sha1(json.dumps(key, sort_keys=True).encode('utf-8')).hexdigest()
+        return os.path.join(os.environ['EXPORTED_MODEL_DIRPATH'],
+                            f'text_vector.{key_digest[:16]}.{EXPORT_BACKENDS[backend].extension}')
+
+    def export_inference_model(self, backend, sample_texts) -> str:
+        assert self._main_config['embedding_type'] == 'text-vector1d'
+        module = TextVectorModule(self._model, dynamic_padding=self._dynamic_padding)
+        input_ids, attention_mask = TransformersEmbedder.batch_encode([self._preprocess_text(text)
+                                                                       for text in sample_texts],
+                                                                      tokenizer=self._tokenizer,
+                                                                      encode_config=self._encode_config,
+                                                                      dynamic_padding=self._dynamic_padding)
+        path = self.exported_model_path(backend)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        EXPORT_BACKENDS[backend].export(module, input_ids, attention_mask, path)
+        return path
+
+    def _new_index(self):
+        if self._main_config['index_type'] == IVFIndex.index_type:
+            return IVFIndex(nlist=self._main_config['ivf_nlist'],
+                            nprobe=self._main_config['ivf_nprobe'],
+                            random_state=self._random_state)
+        return ExactIndex()
 
     def _preprocess_text(self, text: str):
         return TextPreprocessor.normalize_text(text, config=self._preprocessor_config)
 
+    def save_hashtag_segmentations(self):
+        if not self._hashtag_cache_path:
+            return
+        # the file is only a warm start for later processes, failing to write it must not fail a reload
+        try:
+            TextPreprocessor.save_hashtag_segmentations(self._hashtag_cache_path)
+        except OSError:
+            logger.exception('Saving hashtag segmentations to %s failed', self._hashtag_cache_path)
+
     def _embed_text(self, text: str):
-        text = self._preprocess_text(text)
+        return self._embed_batch([self._preprocess_text(text)])[0]
+
+    def _preprocess_series(self, text_series: pd.Series):
+        return np.array(TextPreprocessor.normalize_texts(text_series,
+                                                         n_jobs=self._main_config['preprocessing_workers'],
+                                                         config=self._preprocessor_config))
+
+    def _embed_batch(self, norm_texts):
+        texts = list(norm_texts)
         embedding_type = self._main_config['embedding_type']
         assert embedding_type in ['text-vector1d', 'last-layer-features']
-        if embedding_type == 'text-vector1d':
-            return TransformersEmbedder.text_vector(text=text,
-                                                    pretrained_model=self._model,
-                                                    tokenizer=self._tokenizer,
-                                                    encode_config=self._encode_config,
-                                                    device=self._device,
-                                                    return_tensors=False,
-                                                    random_state=self._random_state)
+        forward_batch_sizes.observe(len(texts))
+        if self._inference_model is not None:
+            encoded = TransformersEmbedder.batch_encode(texts,
+                                                        tokenizer=self._tokenizer,
+                                                        encode_config=self._encode_config,
+                                                        dynamic_padding=self._dynamic_padding)
+            with forward_timer.time():
+                embedded = self._inference_model(*encoded)
+        elif embedding_type == 'text-vector1d':
+            embedded = TransformersEmbedder.batch_text_vector(texts=texts,
+                                                              pretrained_model=self._model,
+                                                              tokenizer=self._tokenizer,
+                                                              encode_config=self._encode_config,
+                                                              device=self._device,
+                                                              return_tensors=False,
+                                                              random_state=self._random_state,
+                                                              dynamic_padding=self._dynamic_padding)
         else:
-            return TransformersEmbedder.last_layer_features(text=text,
-                                                            pretrained_model=self._model,
-                                                            tokenizer=self._tokenizer,
-                                                            encode_config=self._encode_config,
-                                                            device=self._device,
-                                                            return_tensors=False,
-                                                            random_state=self._random_state)
-
-    def _preprocess_series(self, text_series: pd.Series):
-        return np.vectorize(lambda txt: self._preprocess_text(txt))(text_series)
+            embedded = TransformersEmbedder.batch_last_layer_features(texts=texts,
+                                                                      pretrained_model=self._model,
+                                                                      tokenizer=self._tokenizer,
+                                                                      encode_config=self._encode_config,
+                                                                      device=self._device,
+                                                                      return_tensors=False,
+                                                                      random_state=self._random_state)
+        return embedded.reshape(len(texts), -1)
 
-    def _embed_series(self, text_series: pd.Series):
+    def _embed_norm_texts(self, norm_texts):
+        batch_size = self._main_config['batch_size']
+        assert batch_size > 0
+        norm_texts = list(norm_texts)
+        order = np.arange(len(norm_texts))
+        if self._dynamic_padding:
+            # bucket texts of similar length together so that each batch carries little padding
+            order = np.argsort([len(norm_text) for norm_text in norm_texts], kind='stable')
         embedded = []
-        for txt in text_series:
-            embedded.append(self._embed_text(txt).reshape(1, -1))
+        for start in range(0, len(norm_texts), batch_size):
+            embedded.append(self._embed_batch([norm_texts[i] for i in order[start:start + batch_size]]))
         embedded = np.vstack(embedded)
+        if self._dynamic_padding:
+            embedded[order] = embedded.copy()
         return embedded
 
+    def _embed_series(self, text_series: pd.Series):
+        return self._embed_norm_texts(self._preprocess_series(text_series))
+
+    def _embed_stored_texts(self, norm_texts, hashes):
+        if self._embedding_store is None:
+            return self._normalize(self._embed_norm_texts(norm_texts))
+        return self._embedding_store.get_or_embed(
+            hashes, lambda missing: self._normalize(self._embed_norm_texts(norm_texts[missing]))
+        )
+
     def pairwise_cossim(self, text_a: str, text_b: str):
+        embeddings = self.embed_queries([text_a, text_b])
+        return (embeddings[0] @ embeddings[1]).item()
+
+    def _normalize(self, embeddings: np.ndarray) -> np.ndarray:
         norm = self._main_config['embedding_norm']
-        v1 = self._embed_text(text_a)
-        v2 = self._embed_text(text_b)
-        return (normalize(v1.reshape(1, -1), norm=norm)
-                @ normalize(v2.reshape(1, -1), norm=norm).T).item()
+        embeddings = np.asarray(embeddings, dtype=np.float32)
+        if norm == 'l2':
+            lengths = np.linalg.norm(embeddings, axis=1, keepdims=True)
+            lengths[lengths == 0] = 1
+            return np.ascontiguousarray(embeddings / lengths)
+        return np.ascontiguousarray(normalize(embeddings, norm=norm), dtype=np.float32)
+
+    def _build_stored(self, stored_texts: pd.Series, stored_data: pd.DataFrame = None):
+        norm_texts = self._preprocess_series(stored_texts)
+        hashes = [EmbeddingStore.text_hash(norm_text) for norm_text in norm_texts]
+        embeddings = self._embed_stored_texts(norm_texts, hashes)
+        row_labels = np.arange(len(hashes), dtype=np.int64)
+        index = self._new_index().add(row_labels, embeddings)
+        return StoredSnapshot(stored_texts, stored_data, hashes, index, row_labels, row_labels)
+
+    def set_stored_texts(self, stored_texts: pd.Series, stored_data: pd.DataFrame = None):
+        assert stored_data is None or len(stored_data) == len(stored_texts)
+        with self._stored_update_lock:
+            self._stored = self._build_stored(stored_texts, stored_data)
+        self.save_hashtag_segmentations()
+
+    def update_stored_texts(self, stored_texts: pd.Series, stored_data: pd.DataFrame = None):
+        assert stored_data is None or len(stored_data) == len(stored_texts)
+        with self._stored_update_lock:
+            self._update_stored(stored_texts, stored_data)
+        # written once the new snapshot is published
+        self.save_hashtag_segmentations()
+
+    def _update_stored(self, stored_texts: pd.Series, stored_data: pd.DataFrame = None):
+        stored = self._stored
+        if stored.index is None:
+            self._stored = self._build_stored(stored_texts, stored_data)
+            return
+
+        norm_texts = self._preprocess_series(stored_texts)
+        hashes = [EmbeddingStore.text_hash(norm_text) for norm_text in norm_texts]
+        # unchanged texts keep their index entries, duplicates are matched up one to one
+        old_labels = defaultdict(list)
+        for h, label in zip(stored.hashes, stored.row_labels):
+            old_labels[h].append(label)
+        next_label = len(stored.label_rows)
+        row_labels = np.empty(len(hashes), dtype=np.int64)
+        missing = []
+        for i, h in enumerate(hashes):
+            if old_labels[h]:
+                row_labels[i] = old_labels[h].pop(0)
+            else:
+                row_labels[i] = next_label
+                next_label += 1
+                missing.append(i)
+        removed = [label for labels in old_labels.values() for label in labels]
+
+        index = stored.index.copy()
+        index.remove(removed)
+        if missing:
+            if self._embedding_store is not None:
+                embeddings = self._embed_stored_texts(norm_texts, hashes)[missing]
+            else:
+                embeddings = self._normalize(self._embed_norm_texts(norm_texts[missing]))
+            index.add(row_labels[missing], embeddings)
+        label_rows = np.full(next_label, -1, dtype=np.int64)
+        label_rows[row_labels] = np.arange(len(hashes))
+        # readers keep using the previous snapshot until this single assignment
+        self._stored = StoredSnapshot(stored_texts, stored_data, hashes, index, row_labels, label_rows)
+
+    def _embed_norm_queries_now(self, norm_texts):
+        return self._normalize(self._embed_norm_texts(norm_texts))
 
-    def set_stored_texts(self, stored_texts: pd.Series):
-        self.stored_norm_text_embeddings = normalize(self._embed_series(stored_texts),
-                                                     norm=self._main_config['embedding_norm'])
+    def _embed_norm_queries(self, norm_texts):
+        # bulk requests already fill a batch on their own and skip the batching window
+        if self._query_batcher is None or len(norm_texts) >= self._query_batcher.max_batch_size:
+            return self._embed_norm_queries_now(norm_texts)
+        return np.vstack(self._query_batcher.map(norm_texts))
+
+    def embed_queries(self, input_texts) -> np.ndarray:
+        with preprocess_timer.time():
+            norm_texts = [self._preprocess_text(text) for text in input_texts]
+        if self._query_cache is None:
+            return self._embed_norm_queries(norm_texts)
+        embeddings = [self._query_cache.get(norm_text) for norm_text in norm_texts]
+        missing = [i for i, embedding in enumerate(embeddings) if embedding is None]
+        query_cache_hits.inc(len(embeddings) - len(missing))
+        query_cache_misses.inc(len(missing))
+        if missing:
+            computed = self._embed_norm_queries([norm_texts[i] for i in missing])
+            for i, embedding in zip(missing, computed):
+                self._query_cache.put(norm_texts[i], embedding)
+                embeddings[i] = embedding
+        return np.vstack(embeddings)
+
+    def query_batcher_stats(self) -> dict:
+        if self._query_batcher is None:
+            return {}
+        return self._query_batcher.stats()
+
+    def query_cache_stats(self) -> dict:
+        if self._query_cache is None:
+            return {}
+        return self._query_cache.stats()
+
+    def _collect_metrics(self):
+        cache_stats = self.query_cache_stats()
+        if cache_stats:
+            query_cache_entries.set(cache_stats['size'])
+            query_cache_evictions.set(cache_stats['evictions'])
+            query_cache_expirations.set(cache_stats['expirations'])
+        batcher_stats = self.query_batcher_stats()
+        if batcher_stats:
+            query_batches.set(batcher_stats['batches'])
+            query_batch_items.set(batcher_stats['items'])
+
+    @staticmethod
+    def _search_snapshot(stored: StoredSnapshot, query_embeddings: np.ndarray, nbest):
+        with search_timer.time():
+            labels, scores = stored.index.search(query_embeddings, nbest)
+        return stored.label_rows[labels], scores
+
+    def search_stored_embeddings(self, query_embeddings: np.ndarray, nbest=3):
+        query_embeddings = self._normalize(np.asarray(query_embeddings).reshape(len(query_embeddings), -1))
+        return self._search_snapshot(self._stored, query_embeddings, nbest)
 
     def get_stored_best_matches(self,
                                 input_text: str,
                                 nbest=3,
                                 return_indices=False):
-        norm = self._main_config['embedding_norm']
-        input_embedding = normalize(self._embed_text(input_text).reshape(1, -1), norm=norm)
-        scores = (self.stored_norm_text_embeddings @ input_embedding.T).squeeze()
-        indices = np.argsort(scores)
-        indices = indices[-nbest:][::-1]
+        results, scores = self.get_stored_best_matches_batch([input_text],
+                                                             nbest=nbest,
+                                                             return_indices=return_indices)
+        return results[0], scores[0]
+
+    def get_stored_best_matches_batch(self,
+                                      input_texts,
+                                      nbest=3,
+                                      return_indices=False):
+        stored = self._stored
+        indices, scores = self._search_snapshot(stored, self.embed_queries(input_texts), nbest)
         if return_indices:
-            return indices, scores[indices]
-        return self.stored_texts[indices].to_numpy(), scores[indices]
+            return indices, scores
+        return np.vstack([stored.texts.iloc[row].to_numpy() for row in indices]), scores
+
+    def get_stored_best_records(self, input_text: str, nbest=3) -> pd.DataFrame:
+        return self.get_stored_best_records_batch([input_text], nbest=nbest)[0]
+
+    def get_stored_best_records_batch(self, input_texts, nbest=3):
+        stored = self._stored
+        indices, scores = self._search_snapshot(stored, self.embed_queries(input_texts), nbest)
+        stored_data = stored.data if stored.data is not None else stored.texts.to_frame()
+        results = []
+        with records_timer.time():
+            for row_indices, row_scores in zip(indices, scores):
+                records = stored_data.iloc[row_indices].copy()
+                records['score'] = row_scores.astype(np.float64)
+                results.append(records)
+        return results
 
     def get_stored_best_match(self, input_text: str, return_indices=False):
         result, score = self.get_stored_best_matches(input_text,
@@ -118,11 +460,9 @@ class SemanticTextualSimilarityPipeline:
         return result.item(), score.item()
 
     def get_best_matches(self, input_text: str, ref_texts: pd.Series, nbest=1, return_indices=False):
-        norm = self._main_config['embedding_norm']
-        input_embedding = normalize(self._embed_text(input_text).reshape(1, -1), norm=norm)
-        ref_embeddings = normalize(self._embed_series(ref_texts), norm=norm)
-        scores = (ref_embeddings @ input_embedding.T).squeeze()
-        indices = np.argsort(scores)[-nbest:][::-1]
+        input_embedding = self.embed_queries([input_text])
+        ref_embeddings = self._normalize(self._embed_series(ref_texts))
+        indices, scores = top_k(input_embedding @ ref_embeddings.T, nbest)
         if return_indices:
-            return indices, scores[indices]
-        return ref_texts[indices].to_numpy(), scores[indices]
+            return indices[0], scores[0]
+        return ref_texts.iloc[indices[0]].to_numpy(), scores[0]
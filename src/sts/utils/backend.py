@@ -0,0 +1,101 @@
+import copy
+import os
+import threading
+
+import numpy as np
+import torch
+
+
+class TextVectorModule(torch.nn.Module):
+    """
+    The text-vector1d embedding path as one module, for export: the encoder stops at the second-to-last
+    layer, whose token vectors are averaged, so the last layer that the eager path computes and
+    discards is left out of the graph.
+    """
+
+    def __init__(self, pretrained_model, dynamic_padding=False):
+        super().__init__()
+        assert hasattr(pretrained_model, 'encoder') and hasattr(pretrained_model.encoder, 'layer')
+        self.model = copy.deepcopy(pretrained_model).cpu().eval()
+        self.model.encoder.layer = self.model.encoder.layer[:-1]
+        self.model.config.num_hidden_layers = len(self.model.encoder.layer)
+        self.model.config.output_hidden_states = False
+        self.dynamic_padding = dynamic_padding
+
+    def forward(self, input_ids, attention_mask):
+        token_vecs = self.model(input_ids=input_ids, attention_mask=attention_mask)[0]
+        if self.dynamic_padding:
+            mask = attention_mask.unsqueeze(-1).to(token_vecs.dtype)
+            return (token_vecs * mask).sum(dim=1) / mask.sum(dim=1)
+        return torch.mean(token_vecs, dim=1)
+
+
+class TorchScriptBackend:
+    backend = 'torchscript'
+    extension = 'pt'
+
+    def __init__(self, path, device):
+        self._device = device
+        self._module = torch.jit.load(path, map_location=device).eval()
+
+    @staticmethod
+    def export(module: TextVectorModule, input_ids, attention_mask, path):
+        with torch.no_grad():
+            traced = torch.jit.trace(module, (input_ids, attention_mask))
+        traced.save(path)
+
+    def __call__(self, input_ids, attention_mask) -> np.ndarray:
+        with torch.no_grad():
+            return self._module(input_ids.to(self._device), attention_mask.to(self._device)).cpu().numpy()
+
+
+class OnnxBackend:
+    backend = 'onnx'
+    extension = 'onnx'
+
+    def __init__(self, path, device):
+        # onnxruntime is only needed when this backend is selected
+        import onnxruntime
+
+        assert device.type == 'cpu'
+        self._onnxruntime = onnxruntime
+        self._path = path
+        self._lock = threading.Lock()
+        self._pid = None
+        self._inference_session = None
+
+    def _session(self):
+        # the pipeline is built in the preloading server master, each forked worker creates its own session
+        # with the thread count it was given
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    options = self._onnxruntime.SessionOptions()
+                    options.intra_op_num_threads = torch.get_num_threads()
+                    self._inference_session = self._onnxruntime.InferenceSession(
+                        self._path, options, providers=['CPUExecutionProvider'])
+                    self._pid = os.getpid()
+        return self._inference_session
+
+    @staticmethod
+    def export(module: TextVectorModule, input_ids, attention_mask, path):
+        dynamic_axes = {
+            'input_ids': {0: 'batch', 1: 'sequence'},
+            'attention_mask': {0: 'batch', 1: 'sequence'},
+            'text_vector': {0: 'batch'}
+        }
+        with torch.no_grad():
+            torch.onnx.export(module, (input_ids, attention_mask), path,
+                              input_names=['input_ids', 'attention_mask'],
+                              output_names=['text_vector'],
+                              dynamic_axes=dynamic_axes,
+                              opset_version=11)
+
+    def __call__(self, input_ids, attention_mask) -> np.ndarray:
+        return self._session().run(None, {
+            'input_ids': input_ids.cpu().numpy().astype(np.int64),
+            'attention_mask': attention_mask.cpu().numpy().astype(np.int64)
+        })[0]
+
+
+EXPORT_BACKENDS = {backend.backend: backend for backend in [TorchScriptBackend, OnnxBackend]}
@@ -0,0 +1,78 @@
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+
+class MicroBatcher:
+    """
+    Collects items submitted from many threads and processes them together: a batch starts with the
+    first waiting item and takes whatever else arrives within max_wait_ms, up to max_batch_size items.
+    process_batch receives a list of items and returns one result per item, in the same order.
+    """
+
+    def __init__(self, process_batch, max_batch_size=16, max_wait_ms=2.0):
+        assert max_batch_size > 0 and max_wait_ms >= 0
+        self._process_batch = process_batch
+        self.max_batch_size = max_batch_size
+        self.max_wait_ms = max_wait_ms
+        self._lock = threading.Lock()
+        self._pid = None
+        self._queue = None
+        self.batches = 0
+        self.items = 0
+
+    def _pending(self) -> queue.Queue:
+        # threads do not survive a fork, so each forked server worker starts its own
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    self._queue = queue.Queue()
+                    threading.Thread(target=self._run, args=(self._queue,), daemon=True).start()
+                    self._pid = os.getpid()
+        return self._queue
+
+    def submit(self, item) -> Future:
+        future = Future()
+        self._pending().put((item, future))
+        return future
+
+    def map(self, items) -> list:
+        futures = [self.submit(item) for item in items]
+        return [future.result() for future in futures]
+
+    def _run(self, pending: queue.Queue):
+        while True:
+            batch = [pending.get()]
+            deadline = time.monotonic() + self.max_wait_ms / 1000
+            while len(batch) < self.max_batch_size:
+                # past the deadline, items that are already waiting still join the batch
+                timeout = deadline - time.monotonic()
+                try:
+                    batch.append(pending.get(timeout=timeout) if timeout > 0 else pending.get_nowait())
+                except queue.Empty:
+                    break
+            items, futures = zip(*batch)
+            try:
+                results = list(self._process_batch(list(items)))
+                # a short or long result list would leave futures unresolved or answer them with another item's result
+                assert len(results) == len(items), \
+                    f'process_batch returned {len(results)} results for {len(items)} items'
+            except Exception as e:
+                for future in futures:
+                    future.set_exception(e)
+            else:
+                for future, result in zip(futures, results):
+                    future.set_result(result)
+            self.batches += 1
+            self.items += len(batch)
+
+    def stats(self) -> dict:
+        return {
+            'batches': self.batches,
+            'items': self.items,
+            'mean_batch_size': self.items / self.batches if self.batches else 0.0,
+            'max_batch_size': self.max_batch_size,
+            'max_wait_ms': self.max_wait_ms
+        }
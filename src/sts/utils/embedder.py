@@ -15,8 +15,12 @@ import random
 import numpy as np
 from dotenv import load_dotenv, find_dotenv
 
+from metrics import stage_timer
+
 load_dotenv(find_dotenv())
 default_device = torch.device(os.environ['DEFAULT_DEVICE'])
+tokenize_timer = stage_timer('tokenize')
+forward_timer = stage_timer('forward')
 
 
 class TransformersEmbedder:
@@ -52,43 +56,108 @@ class TransformersEmbedder:
         return last_hidden_state, pooled_output, hidden_states
 
     @staticmethod
-    def last_layer_features(
-            text, pretrained_model,
+    def _forward(
+            texts, pretrained_model,
             tokenizer, encode_config,
-            device=default_device, return_tensors='pt',
+            device=default_device,
             random_state=42):
-        last_hidden_state = TransformersEmbedder.extract_features(text=text,
-                                                                  pretrained_model=pretrained_model,
-                                                                  tokenizer=tokenizer,
-                                                                  encode_config=encode_config,
-                                                                  device=device,
-                                                                  return_tensors='pt',
-                                                                  random_state=random_state)[0].squeeze()
-        if return_tensors != 'pt':
-            last_hidden_state = last_hidden_state.detach().cpu().numpy()
-        return last_hidden_state
+        random.seed(random_state)
+        np.random.seed(random_state)
+        torch.manual_seed(random_state)
+        torch.cuda.manual_seed_all(random_state)
+
+        input_ids, attention_mask = TransformersEmbedder.batch_encode(texts, tokenizer, encode_config)
+        input_ids = input_ids.to(device)
+        attention_mask = attention_mask.to(device)
+        pretrained_model.eval()
+        # on GPU this only times the kernel launches, the rest is spent copying the result back
+        with torch.no_grad(), forward_timer.time():
+            return pretrained_model(input_ids=input_ids, attention_mask=attention_mask), attention_mask
 
     @staticmethod
-    def text_vector(
+    def batch_encode(texts, tokenizer, encode_config, dynamic_padding=False):
+        if dynamic_padding:
+            encode_config = TransformersEmbedder.dynamic_padding_config(encode_config)
+        with tokenize_timer.time():
+            encoded_batch = tokenizer.batch_encode_plus(list(texts), **encode_config)
+        return encoded_batch['input_ids'], encoded_batch['attention_mask']
+
+    @staticmethod
+    def dynamic_padding_config(encode_config):
+        # pad to the longest sequence of each batch instead of max_length
+        encode_config = dict(encode_config)
+        encode_config.pop('pad_to_max_length', None)
+        encode_config['padding'] = 'longest'
+        return encode_config
+
+    @staticmethod
+    def last_layer_features(
             text, pretrained_model,
             tokenizer, encode_config,
             device=default_device, return_tensors='pt',
             random_state=42):
-        hidden_states = TransformersEmbedder.extract_features(text=text,
+        return TransformersEmbedder.batch_last_layer_features(texts=[text],
                                                               pretrained_model=pretrained_model,
                                                               tokenizer=tokenizer,
                                                               encode_config=encode_config,
                                                               device=device,
-                                                              return_tensors='pt',
-                                                              random_state=random_state)[2]
-        token_embeddings = torch.squeeze(hidden_states, dim=1)
-        token_embeddings = token_embeddings.permute(1, 0, 2)
-        token_vecs_sum = []
-        for token in token_embeddings:
-            sum_vec = torch.sum(token[-4:], dim=0)
-            token_vecs_sum.append(sum_vec)
-        token_vecs = hidden_states[-2][0]
-        sentence_embedding = torch.mean(token_vecs, dim=0)
+                                                              return_tensors=return_tensors,
+                                                              random_state=random_state)[0]
+
+    @staticmethod
+    def text_vector(
+            text, pretrained_model,
+            tokenizer, encode_config,
+            device=default_device, return_tensors='pt',
+            random_state=42, dynamic_padding=False):
+        return TransformersEmbedder.batch_text_vector(texts=[text],
+                                                      pretrained_model=pretrained_model,
+                                                      tokenizer=tokenizer,
+                                                      encode_config=encode_config,
+                                                      device=device,
+                                                      return_tensors=return_tensors,
+                                                      random_state=random_state,
+                                                      dynamic_padding=dynamic_padding)[0]
+
+    @staticmethod
+    def batch_last_layer_features(
+            texts, pretrained_model,
+            tokenizer, encode_config,
+            device=default_device, return_tensors='pt',
+            random_state=42):
+        # only the last layer leaves the device, the other hidden states are never stacked or copied
+        last_hidden_state = TransformersEmbedder._forward(texts=texts,
+                                                          pretrained_model=pretrained_model,
+                                                          tokenizer=tokenizer,
+                                                          encode_config=encode_config,
+                                                          device=device,
+                                                          random_state=random_state)[0][0].cpu()
+        if return_tensors != 'pt':
+            last_hidden_state = last_hidden_state.numpy()
+        return last_hidden_state
+
+    @staticmethod
+    def batch_text_vector(
+            texts, pretrained_model,
+            tokenizer, encode_config,
+            device=default_device, return_tensors='pt',
+            random_state=42, dynamic_padding=False):
+        if dynamic_padding:
+            encode_config = TransformersEmbedder.dynamic_padding_config(encode_config)
+        # pooled on the device from the second-to-last layer, so only one vector per text is copied back
+        features, attention_mask = TransformersEmbedder._forward(texts=texts,
+                                                                 pretrained_model=pretrained_model,
+                                                                 tokenizer=tokenizer,
+                                                                 encode_config=encode_config,
+                                                                 device=device,
+                                                                 random_state=random_state)
+        token_vecs = features[2][-2]
+        if dynamic_padding:
+            # padding length depends on the batch, so padded positions are left out of the mean
+            mask = attention_mask.unsqueeze(-1).to(token_vecs.dtype)
+            sentence_embeddings = ((token_vecs * mask).sum(dim=1) / mask.sum(dim=1)).cpu()
+        else:
+            sentence_embeddings = torch.mean(token_vecs, dim=1).cpu()
         if return_tensors != 'pt':
-            sentence_embedding = sentence_embedding.detach().cpu().numpy()
-        return sentence_embedding
+            sentence_embeddings = sentence_embeddings.numpy()
+        return sentence_embeddings
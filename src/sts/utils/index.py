@@ -0,0 +1,180 @@
+import copy
+
+import numpy as np
+
+
+def top_k(scores: np.ndarray, k):
+    # O(n) selection per query, then only the k selected scores are sorted
+    k = min(k, scores.shape[1])
+    if k < scores.shape[1]:
+        indices = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    else:
+        indices = np.tile(np.arange(scores.shape[1]), (scores.shape[0], 1))
+    top_scores = np.take_along_axis(scores, indices, axis=1)
+    order = np.argsort(-top_scores, axis=1, kind='stable')
+    return np.take_along_axis(indices, order, axis=1), np.take_along_axis(top_scores, order, axis=1)
+
+
+class ExactIndex:
+    index_type = 'exact'
+
+    def __init__(self):
+        self._embeddings = None
+        self._labels = np.empty(0, dtype=np.int64)
+
+    def __len__(self):
+        return len(self._labels)
+
+    @property
+    def labels(self) -> np.ndarray:
+        return self._labels
+
+    def copy(self):
+        # add and remove always build new arrays, so copies can share the current ones
+        return copy.copy(self)
+
+    def add(self, labels, embeddings: np.ndarray):
+        labels = np.asarray(labels, dtype=np.int64)
+        embeddings = np.asarray(embeddings, dtype=np.float32)
+        assert len(labels) == len(embeddings)
+        if not len(labels):
+            return self
+        if self._embeddings is None:
+            self._embeddings = np.ascontiguousarray(embeddings)
+        else:
+            self._embeddings = np.vstack([self._embeddings, embeddings])
+        self._labels = np.concatenate([self._labels, labels])
+        return self
+
+    def remove(self, labels):
+        keep = ~np.isin(self._labels, np.asarray(labels, dtype=np.int64))
+        if self._embeddings is not None and not keep.all():
+            self._embeddings = self._embeddings[keep]
+            self._labels = self._labels[keep]
+        return keep
+
+    def reconstruct(self, labels) -> np.ndarray:
+        order = np.argsort(self._labels)
+        positions = order[np.searchsorted(self._labels, labels, sorter=order)]
+        return self._embeddings[positions]
+
+    def search(self, query_embeddings: np.ndarray, k):
+        indices, scores = top_k(query_embeddings @ self._embeddings.T, k)
+        return self._labels[indices], scores
+
+    def _state(self) -> dict:
+        return {'embeddings': self._embeddings, 'labels': self._labels}
+
+    def _set_state(self, state):
+        self._embeddings = state['embeddings']
+        self._labels = state['labels']
+
+    def save(self, path):
+        np.savez(path, index_type=self.index_type, **self._state())
+
+    @staticmethod
+    def load(path):
+        state = dict(np.load(path))
+        index_type = str(state.pop('index_type'))
+        index = {ExactIndex.index_type: ExactIndex, IVFIndex.index_type: IVFIndex}[index_type]()
+        index._set_state(state)
+        return index
+
+
+class IVFIndex(ExactIndex):
+    """
+    Inverted file index: stored embeddings are clustered with spherical k-means and a query is only
+    scored against the nprobe clusters whose centroids are closest to it.
+    """
+    index_type = 'ivf'
+
+    def __init__(self, nlist=64, nprobe=8, iterations=10, random_state=108):
+        super().__init__()
+        self.nlist = nlist
+        self.nprobe = nprobe
+        self._iterations = iterations
+        self._random_state = random_state
+        self._centroids = None
+        self._assignments = np.empty(0, dtype=np.int64)
+        # (row order grouped by cluster, start of each cluster in it), one attribute so that readers
+        # never pair an order with the offsets of another
+        self._lists = None
+
+    def _build_lists(self):
+        # built before the index is published, so concurrent searches only ever read it
+        list_order = np.argsort(self._assignments, kind='stable')
+        list_offsets = np.searchsorted(self._assignments[list_order], np.arange(len(self._centroids) + 1))
+        self._lists = (list_order, list_offsets)
+
+    def _assign(self, embeddings, chunk_size=8192):
+        return np.concatenate([np.argmax(embeddings[start:start + chunk_size] @ self._centroids.T, axis=1)
+                               for start in range(0, len(embeddings), chunk_size)])
+
+    def train(self, embeddings: np.ndarray):
+        rng = np.random.RandomState(self._random_state)
+        nlist = min(self.nlist, len(embeddings))
+        centroids = embeddings[rng.choice(len(embeddings), nlist, replace=False)].copy()
+        for _ in range(self._iterations):
+            self._centroids = centroids
+            assignments = self._assign(embeddings)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, assignments, embeddings)
+            lengths = np.linalg.norm(sums, axis=1, keepdims=True)
+            # an emptied cluster keeps its previous centroid
+            centroids = np.where(lengths > 0, sums / np.maximum(lengths, 1e-12), centroids).astype(np.float32)
+        self._centroids = centroids
+        if self._embeddings is not None:
+            self._assignments = self._assign(self._embeddings)
+            self._build_lists()
+
+    def add(self, labels, embeddings: np.ndarray):
+        embeddings = np.asarray(embeddings, dtype=np.float32)
+        if not len(embeddings):
+            return self
+        if self._centroids is None:
+            self.train(embeddings)
+        super().add(labels, embeddings)
+        self._assignments = np.concatenate([self._assignments, self._assign(embeddings)])
+        self._build_lists()
+        return self
+
+    def remove(self, labels):
+        keep = super().remove(labels)
+        if not keep.all():
+            self._assignments = self._assignments[keep]
+            self._build_lists()
+        return keep
+
+    def search(self, query_embeddings: np.ndarray, k):
+        list_order, list_offsets = self._lists
+        probes = top_k(query_embeddings @ self._centroids.T, self.nprobe)[0]
+        k = min(k, len(self))
+        labels = np.empty((len(query_embeddings), k), dtype=np.int64)
+        scores = np.empty((len(query_embeddings), k), dtype=np.float32)
+        for i, (query_embedding, query_probes) in enumerate(zip(query_embeddings, probes)):
+            candidates = np.concatenate([list_order[list_offsets[c]:list_offsets[c + 1]] for c in query_probes])
+            if len(candidates) < k:
+                candidates = np.arange(len(self))
+            indices, candidate_scores = top_k((self._embeddings[candidates] @ query_embedding)[np.newaxis], k)
+            labels[i] = self._labels[candidates[indices[0]]]
+            scores[i] = candidate_scores[0]
+        return labels, scores
+
+    def _state(self) -> dict:
+        state = super()._state()
+        state.update({
+            'centroids': self._centroids,
+            'assignments': self._assignments,
+            'nlist': self.nlist,
+            'nprobe': self.nprobe
+        })
+        return state
+
+    def _set_state(self, state):
+        super()._set_state(state)
+        self._centroids = state['centroids']
+        self._assignments = state['assignments']
+        self.nlist = int(state['nlist'])
+        self.nprobe = int(state['nprobe'])
+        if self._centroids is not None:
+            self._build_lists()
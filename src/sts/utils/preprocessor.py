@@ -10,134 +10,241 @@ Identifying COVID-19 Information on the Twitter Social Network"
 from nltk.tokenize import TweetTokenizer
 from emoji import demojize, emoji_count
 import pandas as pd
+import json
+import os
 import re
+import tempfile
+import threading
 import html
 import unicodedata
 import unidecode
+from functools import lru_cache
 import preprocessor as p
 from ekphrasis.classes.segmenter import Segmenter
 import contractions
+import itertools
+import multiprocessing
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from sts.utils.cache import LRUCache
+
+
+def _compile_rules(rules):
+    detector = re.compile('|'.join(f'(?i:{pattern})' if flags & re.I else f'(?:{pattern})'
+                                   for pattern, _, flags in rules))
+    return detector, [(re.compile(pattern, flags), replacement) for pattern, replacement, flags in rules]
+
+
+@lru_cache(maxsize=None)
+def _normalize_punctuation_char(ch):
+    return unidecode.unidecode(ch) if unicodedata.category(ch)[0] == 'P' else ch
+
+
+@lru_cache(maxsize=None)
+def _is_control_char(ch):
+    return unicodedata.category(ch)[0] == 'C'
 
 
 class TextPreprocessor:
-    _seg_tw = Segmenter(corpus="twitter")
+    # loading the twitter word statistics is slow, so the segmenter is only built on first use
+    _seg_tw = None
+    _seg_tw_lock = threading.Lock()
+    _hashtag_segmentations = LRUCache(maxsize=16384)
     _w_tokenizer = TweetTokenizer()
     _control_char_regex = re.compile(r'[\r\n\t]+')
+    _ascii_control_char_regex = re.compile(r'[\x00-\x1f\x7f]')
     _transl_table = dict([(ord(x), ord(y)) for x, y in zip(u"‘’´“”–ー-", u"'''\"\"---")])
+    _special_character_rules = _compile_rules([
+        (r"\x89Û_", "", 0),
+        (r"\x89ÛÒ", "", 0),
+        (r"\x89ÛÓ", "", 0),
+        (r"\x89ÛÏWhen", "When", 0),
+        (r"\x89ÛÏ", "", 0),
+        (r"China\x89Ûªs", "China's", 0),
+        (r"let\x89Ûªs", "let's", 0),
+        (r"\x89Û÷", "", 0),
+        (r"\x89Ûª", "", 0),
+        (r"\x89Û\x9d", "", 0),
+        (r"å_", "", 0),
+        (r"\x89Û¢", "", 0),
+        (r"\x89Û¢åÊ", "", 0),
+        (r"fromåÊwounds", "from wounds", 0),
+        (r"åÊ", "", 0),
+        (r"åÈ", "", 0),
+        (r"JapÌ_n", "Japan", 0),
+        (r"Ì©", "e", 0),
+        (r"å¨", "", 0),
+        (r"SuruÌ¤", "Suruc", 0),
+        (r"åÇ", "", 0),
+        (r"å£3million", "3 million", 0),
+        (r"åÀ", "", 0)
+    ])
+    _contraction_rules = _compile_rules([
+        (r"don\x89Ûªt", "do not", 0),
+        (r"I\x89Ûªm", "I am", 0),
+        (r"you\x89Ûªve", "you have", 0),
+        (r"it\x89Ûªs", "it is", 0),
+        (r"doesn\x89Ûªt", "does not", 0),
+        (r"It\x89Ûªs", "It is", 0),
+        (r"Here\x89Ûªs", "Here is", 0),
+        (r"I\x89Ûªve", "I have", 0),
+        (r"can\x89Ûªt", "cannot", 0),
+        (r"That\x89Ûªs", "That is", 0),
+        (r"that\x89Ûªs", "that is", 0),
+        (r"This\x89Ûªs", "This is", 0),
+        (r"this\x89Ûªs", "this is", 0),
+        (r"You\x89Ûªre", "You are", 0),
+        (r"Don\x89Ûªt", "Do not", 0),
+        (r"Can\x89Ûªt", "Cannot", 0),
+        (r"you\x89Ûªll", "you will", 0),
+        (r"I\x89Ûªd", "I would", 0),
+        (r"donå«t", "do not", 0),
+        (r"He's", "He is", 0),
+        (r"She's", "She is", 0),
+        (r"It's", "It is", 0),
+        (r"he's", "he is", 0),
+        (r"she's", "she is", 0),
+        (r"it's", "it is", 0),
+        (r"He ain't", "He is not", 0),
+        (r"She aint't", "She is not", 0),
+        (r"It aint't", "It is not", 0),
+        (r"he aint't", "he is not", 0),
+        (r"she aint't", "she is not", 0),
+        (r"it aint't", "it is not", 0)
+    ])
+    _abbreviation_rules = _compile_rules([
+        (r'R\.I\.P', 'Rest In Peace', 0),
+        (r'R\.i\.p', 'Rest in peace', 0),
+        (r'r\.i\.p', 'rest in peace', 0),
+        (r"U\.S", "United States", 0),
+        (r"u\.s", "united states", 0),
+        (r"w/e", "whatever", 0),
+        (r"w/", "with", 0),
+        (r"USAgov", "USA government", 0),
+        (r"usagov", "usa government", 0),
+        (r"recentlu", "recently", 0),
+        (r"Ph0tos", "Photos", 0),
+        (r"ph0tos", "photos", 0),
+        (r"amirite", "am I right", 0),
+        (r"exp0sed", "exposed", 0),
+        (r"<3", "love", 0),
+        (r"amageddon", "armageddon", 0),
+        (r"Trfc", "Traffic", 0),
+        (r"trfc", "traffic", 0),
+        (r"([0-9]+)(yr)", r"\1 years", 0),
+        (r"lmao", "laughing my ass off", re.I),
+        (r"lol", "laughing out loud", re.I),
+        (r"TRAUMATISED", "traumatized", 0),
+        (r"traumatised", "traumatized", 0),
+        (r"ppl", "people", 0),
+        (r"Ppl", "People", 0),
+        (r"sh\*t", r"shit", 0)
+    ])
+    _covid_rules = [
+        (re.compile(r"(covid.19)", flags=re.I), "COVID 19 "),
+        (re.compile(r"(covid...19)", flags=re.I), "COVID 19 "),
+        (re.compile(r"covid19", flags=re.I), " COVID 19 "),
+        (re.compile(r"# COVID19", flags=re.I), "#COVID 19"),
+        (re.compile(r"# COVID19", flags=re.I), "#COVID 19")
+    ]
+    _time_and_number_rules = [
+        (re.compile(r" p \. m \.", flags=re.I), "  p.m."),
+        (re.compile(r" p \. m ", flags=re.I), " p.m "),
+        (re.compile(r" a \. m \.", flags=re.I), "  a.m."),
+        (re.compile(r" a \. m ", flags=re.I), " a.m "),
+        (re.compile(r"'s"), " 's "),
+        (re.compile(r"(covid.19)", flags=re.I), "COVID19"),
+        (re.compile(r",([0-9]{2,4}) , ([0-9]{2,4})"), r",\1,\2"),
+        (re.compile(r"([0-9]{1,3}) / ([0-9]{2,4})"), r"\1/\2"),
+        (re.compile(r"([0-9]{1,3})- ([0-9]{2,4})"), r"\1-\2")
+    ]
+    _whitespace_regex = re.compile(r'\s+')
+    _quotes_regex = re.compile(r'\"+')
+
+    @staticmethod
+    def _apply_rules(norm_text, compiled_rules):
+        detector, rules = compiled_rules
+        # rules run in order, so none of them can fire unless one pattern already occurs in the input
+        if detector.search(norm_text) is None:
+            return norm_text
+        for pattern, replacement in rules:
+            norm_text = pattern.sub(replacement, norm_text)
+        return norm_text
 
     @staticmethod
     def normalize_punctuation(norm_text):
         # handle punctuation
         norm_text = norm_text.translate(TextPreprocessor._transl_table)
         norm_text = norm_text.replace('…', '...')
-        norm_text = ''.join([unidecode.unidecode(t) if unicodedata.category(t)[0] == 'P' else t for t in norm_text])
+        if not norm_text.isascii():
+            # ASCII punctuation is left unchanged by unidecode
+            norm_text = ''.join([_normalize_punctuation_char(t) for t in norm_text])
         if '...' not in norm_text:
             norm_text = norm_text.replace('..', ' ... ')
         return norm_text
 
     @staticmethod
     def normalize_special_characters(norm_text):
-        norm_text = re.sub(r"\x89Û_", "", norm_text)
-        norm_text = re.sub(r"\x89ÛÒ", "", norm_text)
-        norm_text = re.sub(r"\x89ÛÓ", "", norm_text)
-        norm_text = re.sub(r"\x89ÛÏWhen", "When", norm_text)
-        norm_text = re.sub(r"\x89ÛÏ", "", norm_text)
-        norm_text = re.sub(r"China\x89Ûªs", "China's", norm_text)
-        norm_text = re.sub(r"let\x89Ûªs", "let's", norm_text)
-        norm_text = re.sub(r"\x89Û÷", "", norm_text)
-        norm_text = re.sub(r"\x89Ûª", "", norm_text)
-        norm_text = re.sub(r"\x89Û\x9d", "", norm_text)
-        norm_text = re.sub(r"å_", "", norm_text)
-        norm_text = re.sub(r"\x89Û¢", "", norm_text)
-        norm_text = re.sub(r"\x89Û¢åÊ", "", norm_text)
-        norm_text = re.sub(r"fromåÊwounds", "from wounds", norm_text)
-        norm_text = re.sub(r"åÊ", "", norm_text)
-        norm_text = re.sub(r"åÈ", "", norm_text)
-        norm_text = re.sub(r"JapÌ_n", "Japan", norm_text)
-        norm_text = re.sub(r"Ì©", "e", norm_text)
-        norm_text = re.sub(r"å¨", "", norm_text)
-        norm_text = re.sub(r"SuruÌ¤", "Suruc", norm_text)
-        norm_text = re.sub(r"åÇ", "", norm_text)
-        norm_text = re.sub(r"å£3million", "3 million", norm_text)
-        norm_text = re.sub(r"åÀ", "", norm_text)
+        norm_text = TextPreprocessor._apply_rules(norm_text, TextPreprocessor._special_character_rules)
         norm_text = html.unescape(norm_text)
         return norm_text
 
     @staticmethod
     def normalize_contractions(norm_text):
         # Contractions
-        norm_text = re.sub(r"don\x89Ûªt", "do not", norm_text)
-        norm_text = re.sub(r"I\x89Ûªm", "I am", norm_text)
-        norm_text = re.sub(r"you\x89Ûªve", "you have", norm_text)
-        norm_text = re.sub(r"it\x89Ûªs", "it is", norm_text)
-        norm_text = re.sub(r"doesn\x89Ûªt", "does not", norm_text)
-        norm_text = re.sub(r"It\x89Ûªs", "It is", norm_text)
-        norm_text = re.sub(r"Here\x89Ûªs", "Here is", norm_text)
-        norm_text = re.sub(r"I\x89Ûªve", "I have", norm_text)
-        norm_text = re.sub(r"can\x89Ûªt", "cannot", norm_text)
-        norm_text = re.sub(r"That\x89Ûªs", "That is", norm_text)
-        norm_text = re.sub(r"that\x89Ûªs", "that is", norm_text)
-        norm_text = re.sub(r"This\x89Ûªs", "This is", norm_text)
-        norm_text = re.sub(r"this\x89Ûªs", "this is", norm_text)
-        norm_text = re.sub(r"You\x89Ûªre", "You are", norm_text)
-        norm_text = re.sub(r"Don\x89Ûªt", "Do not", norm_text)
-        norm_text = re.sub(r"Can\x89Ûªt", "Cannot", norm_text)
-        norm_text = re.sub(r"you\x89Ûªll", "you will", norm_text)
-        norm_text = re.sub(r"I\x89Ûªd", "I would", norm_text)
-        norm_text = re.sub(r"donå«t", "do not", norm_text)
-
-        norm_text = re.sub(r"He's", "He is", norm_text)
-        norm_text = re.sub(r"She's", "She is", norm_text)
-        norm_text = re.sub(r"It's", "It is", norm_text)
-        norm_text = re.sub(r"he's", "he is", norm_text)
-        norm_text = re.sub(r"she's", "she is", norm_text)
-        norm_text = re.sub(r"it's", "it is", norm_text)
-
-        norm_text = re.sub(r"He ain't", "He is not", norm_text)
-        norm_text = re.sub(r"She aint't", "She is not", norm_text)
-        norm_text = re.sub(r"It aint't", "It is not", norm_text)
-        norm_text = re.sub(r"he aint't", "he is not", norm_text)
-        norm_text = re.sub(r"she aint't", "she is not", norm_text)
-        norm_text = re.sub(r"it aint't", "it is not", norm_text)
+        norm_text = TextPreprocessor._apply_rules(norm_text, TextPreprocessor._contraction_rules)
         norm_text = contractions.fix(norm_text)
         return norm_text
 
     @staticmethod
     def normalize_abbreviations(norm_text):
-        norm_text = re.sub(r'R\.I\.P', 'Rest In Peace', norm_text)
-        norm_text = re.sub(r'R\.i\.p', 'Rest in peace', norm_text)
-        norm_text = re.sub(r'r\.i\.p', 'rest in peace', norm_text)
-        norm_text = re.sub(r"U\.S", "United States", norm_text)
-        norm_text = re.sub(r"u\.s", "united states", norm_text)
-        norm_text = re.sub(r"w/e", "whatever", norm_text)
-        norm_text = re.sub(r"w/", "with", norm_text)
-        norm_text = re.sub(r"USAgov", "USA government", norm_text)
-        norm_text = re.sub(r"usagov", "usa government", norm_text)
-        norm_text = re.sub(r"recentlu", "recently", norm_text)
-        norm_text = re.sub(r"Ph0tos", "Photos", norm_text)
-        norm_text = re.sub(r"ph0tos", "photos", norm_text)
-        norm_text = re.sub(r"amirite", "am I right", norm_text)
-        norm_text = re.sub(r"exp0sed", "exposed", norm_text)
-        norm_text = re.sub(r"<3", "love", norm_text)
-        norm_text = re.sub(r"amageddon", "armageddon", norm_text)
-        norm_text = re.sub(r"Trfc", "Traffic", norm_text)
-        norm_text = re.sub(r"trfc", "traffic", norm_text)
-        norm_text = re.sub(r"([0-9]+)(yr)", r"\1 years", norm_text)
-        norm_text = re.sub(r"lmao", "laughing my ass off", norm_text, flags=re.I)
-        norm_text = re.sub(r"lol", "laughing out loud", norm_text, flags=re.I)
-        norm_text = re.sub(r"TRAUMATISED", "traumatized", norm_text)
-        norm_text = re.sub(r"traumatised", "traumatized", norm_text)
-        norm_text = re.sub(r"ppl", "people", norm_text)
-        norm_text = re.sub(r"Ppl", "People", norm_text)
-        norm_text = re.sub(r"sh\*t", r"shit", norm_text)
+        norm_text = TextPreprocessor._apply_rules(norm_text, TextPreprocessor._abbreviation_rules)
         norm_text = norm_text.replace("cv19", "COVID 19")
         norm_text = norm_text.replace("cvid19", "COVID 19")
         return norm_text
 
+    @staticmethod
+    def _segmenter():
+        if TextPreprocessor._seg_tw is None:
+            with TextPreprocessor._seg_tw_lock:
+                if TextPreprocessor._seg_tw is None:
+                    TextPreprocessor._seg_tw = Segmenter(corpus="twitter")
+        return TextPreprocessor._seg_tw
+
+    @staticmethod
+    def segment_hashtag(hashtag):
+        segmented = TextPreprocessor._hashtag_segmentations.get(hashtag)
+        if segmented is None:
+            segmented = TextPreprocessor._segmenter().segment(hashtag)
+            TextPreprocessor._hashtag_segmentations.put(hashtag, segmented)
+        return segmented
+
+    @staticmethod
+    def load_hashtag_segmentations(path):
+        if not os.path.exists(path):
+            return
+        with open(path) as JSON:
+            for hashtag, segmented in json.loads(JSON.read()).items():
+                TextPreprocessor._hashtag_segmentations.put(hashtag, segmented)
+
+    @staticmethod
+    def save_hashtag_segmentations(path):
+        dirpath = os.path.dirname(os.path.abspath(path))
+        os.makedirs(dirpath, exist_ok=True)
+        # every worker saves, each one through a temporary file of its own
+        fd, tmp_path = tempfile.mkstemp(dir=dirpath, prefix='.tmp.')
+        try:
+            with os.fdopen(fd, 'w') as JSON:
+                JSON.write(json.dumps(dict(TextPreprocessor._hashtag_segmentations.items())))
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+
     @staticmethod
     def normalize_hashtag(norm_text):
         for hashtag in re.findall(r"#(\w+)", norm_text):
-            norm_text = norm_text.replace(f'#{hashtag}', '#' + TextPreprocessor._seg_tw.segment(hashtag))
+            norm_text = norm_text.replace(f'#{hashtag}', '#' + TextPreprocessor.segment_hashtag(hashtag))
         return norm_text
 
     @staticmethod
@@ -233,12 +340,9 @@ class TextPreprocessor:
         norm_text = TextPreprocessor.replace_multi_occurrences(norm_text, username)
         norm_text = TextPreprocessor.replace_multi_occurrences(norm_text, httpurl)
 
-        norm_text = re.sub(r"(covid.19)", "COVID 19 ", norm_text, flags=re.I)
-        norm_text = re.sub(r"(covid...19)", "COVID 19 ", norm_text, flags=re.I)
-        norm_text = re.sub(r"covid19", " COVID 19 ", norm_text, flags=re.I)
-        norm_text = re.sub(r"# COVID19", "#COVID 19", norm_text, flags=re.I)
-        norm_text = re.sub(r"# COVID19", "#COVID 19", norm_text, flags=re.I)
-        norm_text = re.sub(r'\s+', ' ', norm_text).strip()
+        for pattern, replacement in TextPreprocessor._covid_rules:
+            norm_text = pattern.sub(replacement, norm_text)
+        norm_text = TextPreprocessor._whitespace_regex.sub(' ', norm_text).strip()
 
         if segment_hashtag:
             norm_text = TextPreprocessor.normalize_hashtag(norm_text)
@@ -246,31 +350,25 @@ class TextPreprocessor:
         norm_text = p.clean(norm_text)
 
         # replace \t, \n and \r characters by a whitespace
-        norm_text = re.sub(TextPreprocessor._control_char_regex, ' ', norm_text)
+        norm_text = TextPreprocessor._control_char_regex.sub(' ', norm_text)
         # remove all remaining control characters
-        norm_text = ''.join(ch for ch in norm_text if unicodedata.category(ch)[0] != 'C')
+        if norm_text.isascii():
+            norm_text = TextPreprocessor._ascii_control_char_regex.sub('', norm_text)
+        else:
+            norm_text = ''.join(ch for ch in norm_text if not _is_control_char(ch))
 
-        norm_text = re.sub(r" p \. m \.", "  p.m.", norm_text, flags=re.I)
-        norm_text = re.sub(r" p \. m ", " p.m ", norm_text, flags=re.I)
-        norm_text = re.sub(r" a \. m \.", "  a.m.", norm_text, flags=re.I)
-        norm_text = re.sub(r" a \. m ", " a.m ", norm_text, flags=re.I)
-        norm_text = re.sub(r"'s", " 's ", norm_text)
-        norm_text = re.sub(r"(covid.19)", "COVID19", norm_text, flags=re.I)
+        for pattern, replacement in TextPreprocessor._time_and_number_rules:
+            norm_text = pattern.sub(replacement, norm_text)
 
-        norm_text = re.sub(r",([0-9]{2,4}) , ([0-9]{2,4})", r",\1,\2", norm_text)
-        norm_text = re.sub(r"([0-9]{1,3}) / ([0-9]{2,4})", r"\1/\2", norm_text)
-        norm_text = re.sub(r"([0-9]{1,3})- ([0-9]{2,4})", r"\1-\2", norm_text)
-
-        if to_ascii:
-            norm_text = ''.join(ch for ch in norm_text if unicodedata.category(ch)[0] != 'So')
+        if to_ascii and not norm_text.isascii():
             norm_text = unicodedata.normalize('NFKD', norm_text).encode('ascii', 'ignore').decode('utf-8')
         if to_lower:
             norm_text = norm_text.lower()
 
         while '""' in norm_text:
             norm_text = norm_text.replace('""', '"')
-        norm_text = re.sub(r'\"+', '"', norm_text)
-        norm_text = re.sub(r'\s+', ' ', norm_text).strip()
+        norm_text = TextPreprocessor._quotes_regex.sub('"', norm_text)
+        norm_text = TextPreprocessor._whitespace_regex.sub(' ', norm_text).strip()
         return norm_text
 
     @staticmethod
@@ -281,15 +379,61 @@ class TextPreprocessor:
                          keep_emojis=True,
                          segment_hashtag=False,
                          username="@USER",
-                         httpurl="HTTPURL") -> pd.Series:
-        return text_series.apply(lambda txt: TextPreprocessor.normalize_text(txt,
-                                                                             config=config,
-                                                                             to_ascii=to_ascii,
-                                                                             to_lower=to_lower,
-                                                                             keep_emojis=keep_emojis,
-                                                                             segment_hashtag=segment_hashtag,
-                                                                             username=username,
-                                                                             httpurl=httpurl))
+                         httpurl="HTTPURL",
+                         n_jobs=1) -> pd.Series:
+        norm_texts = TextPreprocessor.normalize_texts(text_series,
+                                                      n_jobs=n_jobs,
+                                                      config=config,
+                                                      to_ascii=to_ascii,
+                                                      to_lower=to_lower,
+                                                      keep_emojis=keep_emojis,
+                                                      segment_hashtag=segment_hashtag,
+                                                      username=username,
+                                                      httpurl=httpurl)
+        return pd.Series(norm_texts, index=text_series.index, name=text_series.name, dtype=object)
+
+    @staticmethod
+    def iter_normalize_texts(texts, n_jobs=None, chunk_size=1000, **kwargs):
+        # yields normalized texts in input order while reading the input lazily, chunk by chunk
+        n_jobs = n_jobs or multiprocessing.cpu_count()
+        assert n_jobs > 0 and chunk_size > 0
+        texts = iter(texts)
+        chunks = iter(lambda: list(itertools.islice(texts, chunk_size)), [])
+        if n_jobs == 1:
+            for chunk in chunks:
+                yield from _normalize_chunk(chunk, kwargs)
+            return
+
+        segment_hashtag = kwargs['config']['segment_hashtag'] if kwargs.get('config') is not None \
+            else kwargs.get('segment_hashtag', True)
+        with ProcessPoolExecutor(max_workers=n_jobs,
+                                 initializer=_init_worker,
+                                 initargs=(segment_hashtag,
+                                           dict(TextPreprocessor._hashtag_segmentations.items()))) as executor:
+            # at most two chunks per worker are in flight, so memory stays bounded on long inputs
+            pending = deque()
+            for chunk in chunks:
+                pending.append(executor.submit(_normalize_chunk, chunk, kwargs))
+                if len(pending) >= 2 * n_jobs:
+                    yield from pending.popleft().result()
+            while pending:
+                yield from pending.popleft().result()
+
+    @staticmethod
+    def normalize_texts(texts, n_jobs=None, chunk_size=1000, **kwargs) -> list:
+        return list(TextPreprocessor.iter_normalize_texts(texts, n_jobs=n_jobs, chunk_size=chunk_size, **kwargs))
+
+
+def _init_worker(segment_hashtag, hashtag_segmentations):
+    # every worker loads the segmenter once and starts from the parent's memoized hashtags
+    for hashtag, segmented in hashtag_segmentations.items():
+        TextPreprocessor._hashtag_segmentations.put(hashtag, segmented)
+    if segment_hashtag:
+        TextPreprocessor._segmenter()
+
+
+def _normalize_chunk(texts, kwargs):
+    return [TextPreprocessor.normalize_text(text, **kwargs) for text in texts]
 
 
 if __name__ == "__main__":
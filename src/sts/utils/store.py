@@ -0,0 +1,120 @@
+import hashlib
+import json
+import os
+import tempfile
+from contextlib import contextmanager
+
+import numpy as np
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+class EmbeddingStore:
+    # 2: rows are stored normalized
+    version = 2
+
+    def __init__(self, dirpath, key: dict):
+        self._key = key
+        key_digest = hashlib.sha1(json.dumps(key, sort_keys=True).encode('utf-8')).hexdigest()
+        self._dirpath = os.path.join(dirpath, key_digest[:16])
+        self._manifest_path = os.path.join(self._dirpath, 'manifest.json')
+
+    @staticmethod
+    def text_hash(norm_text: str) -> str:
+        return hashlib.sha1(norm_text.encode('utf-8')).hexdigest()
+
+    def load(self, attempts=3):
+        # another worker may replace the manifest and remove the file it named between the two reads,
+        # the manifest is then read again
+        for _ in range(attempts):
+            if not os.path.exists(self._manifest_path):
+                return [], None
+            with open(self._manifest_path) as JSON:
+                manifest = json.loads(JSON.read())
+            if manifest['version'] != EmbeddingStore.version or manifest['key'] != self._key:
+                return [], None
+            try:
+                embeddings = np.load(os.path.join(self._dirpath, manifest['embeddings']), mmap_mode='r')
+            except FileNotFoundError:
+                continue
+            assert embeddings.shape[0] == len(manifest['hashes'])
+            return manifest['hashes'], embeddings
+        return [], None
+
+    def _replace(self, path, write):
+        # written next to the target under a name of its own and moved over it, so that workers saving
+        # at the same time never share a partial file
+        fd, tmp_path = tempfile.mkstemp(dir=self._dirpath, prefix='.tmp.')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                write(f)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+
+    @contextmanager
+    def _locked(self):
+        # workers saving at the same time take turns, so each one removes the file the manifest named
+        # before it, not one another worker has just written. Without fcntl they do not wait.
+        with open(os.path.join(self._dirpath, '.lock'), 'a') as lock_file:
+            if fcntl is not None:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+            yield
+
+    def save(self, hashes, embeddings: np.ndarray):
+        assert embeddings.shape[0] == len(hashes)
+        os.makedirs(self._dirpath, exist_ok=True)
+        with self._locked():
+            self._save(hashes, embeddings)
+
+    def _save(self, hashes, embeddings: np.ndarray):
+        previous = None
+        if os.path.exists(self._manifest_path):
+            with open(self._manifest_path) as JSON:
+                previous = json.loads(JSON.read()).get('embeddings')
+
+        content_digest = hashlib.sha1(''.join(hashes).encode('utf-8')).hexdigest()
+        filename = f'embeddings.{content_digest[:16]}.npy'
+        embeddings_path = os.path.join(self._dirpath, filename)
+        # the name is derived from the content, a file already there has the same rows and may be
+        # memory-mapped by another worker
+        if not os.path.exists(embeddings_path):
+            self._replace(embeddings_path, lambda f: np.save(f, np.asarray(embeddings, dtype=np.float32)))
+        manifest = {
+            'version': EmbeddingStore.version,
+            'key': self._key,
+            'embeddings': filename,
+            'hashes': list(hashes)
+        }
+        self._replace(self._manifest_path, lambda f: f.write(json.dumps(manifest).encode('utf-8')))
+        if previous is not None and previous != filename:
+            # workers that mapped it keep their mapping, another worker may have removed it already
+            try:
+                os.remove(os.path.join(self._dirpath, previous))
+            except FileNotFoundError:
+                pass
+
+    def get_or_embed(self, hashes, embed_missing):
+        # rows already in the store come from the memory-mapped file, only the missing ones are embedded
+        stored_hashes, stored_embeddings = self.load()
+        stored_positions = {h: i for i, h in enumerate(stored_hashes)}
+        missing = [i for i, h in enumerate(hashes) if h not in stored_positions]
+        if not missing and list(hashes) == list(stored_hashes):
+            return stored_embeddings
+
+        if not hashes:
+            return np.empty((0, 0), dtype=np.float32)
+        computed = embed_missing(missing) if missing else None
+        dim = computed.shape[1] if computed is not None else stored_embeddings.shape[1]
+        embeddings = np.empty((len(hashes), dim), dtype=np.float32)
+        if missing:
+            embeddings[missing] = computed
+        found = [i for i, h in enumerate(hashes) if h in stored_positions]
+        if found:
+            embeddings[found] = stored_embeddings[[stored_positions[hashes[i]] for i in found]]
+        self.save(hashes, embeddings)
+        return embeddings
@@ -8,6 +8,8 @@ from telegram import InlineKeyboardButton, InlineKeyboardMarkup, Update
 from telegram.ext import *
 
 from data.firebase import FirebaseDBManager
+from data.user_cache import UserCache
+from faq_service import FAQService, MainAPIClient
 
 logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
 
@@ -16,7 +18,7 @@ with open(os.environ['TELEBOT_CONFIG_PATH']) as JSON:
     telebot_config = json.loads(JSON.read())
 
 logging.info(f'Starting Bot..., name = {telebot_config["bot_name"]}')
-if telebot_config['main_api_connection'] == 'default':
+if telebot_config['main_api_connection'] in ['default', 'embedded']:
     with open(os.environ['API_CONFIG_PATH']) as JSON:
         main_api_config = json.loads(JSON.read())
         main_api_key = main_api_config['secret_key']
@@ -28,21 +30,20 @@ else:
     main_api_key = telebot_config['main_api_connection']['secret_key']
     main_api_url = telebot_config['main_api_connection']['url']
 
-cached_data_form = {
-    "fdbk": {},
-    "ofaqs": {},
-    "pre_question": {}
-}
-cached_data = dict()
+# per-user namespaces: "fdbk" and "ofaqs" by message id, "pre_question" by lowercased question
+user_cache = UserCache(maxsize=telebot_config['cache_size'],
+                       max_per_user=telebot_config['cache_size_per_user'],
+                       ttl=telebot_config['cache_ttl'])
 
-r = requests.get(
-    main_api_url + '/',
-    params={
-        'secret_key': main_api_key
-    }
-)
-if r.status_code == 200:
-    logging.info(f'Connected to main api: url = {main_api_url}')
+# "embedded" runs the STS pipeline in this process, with no HTTP hop and no main API to deploy;
+# otherwise the bot is a client of the main API, over one connection pool shared by all handler threads
+if telebot_config['main_api_connection'] == 'embedded':
+    main_api = FAQService(main_api_config['similarity_threshold'], main_api_config['batch_chunk_size'])
+else:
+    main_api = MainAPIClient(main_api_url,
+                             main_api_key,
+                             pool_size=telebot_config['workers'],
+                             timeout=(telebot_config['api_connect_timeout'], telebot_config['api_read_timeout']))
 
 
 def start_command(update: Update, context: CallbackContext):
@@ -93,65 +94,49 @@ def cache_question_data(update: Update, nearest_faq=None, other_faq_questions=No
         user_question = user_question.lstrip(' ').rstrip('\n').rstrip(' ')
     assert (nearest_faq is None and other_faq_questions is None) \
            or (nearest_faq is not None and other_faq_questions is not None)
+    user_id = update.message.from_user.id
     if nearest_faq is None:
-        cached_data[update.message.from_user.id]['pre_question'].update({
-            user_question.lower(): "not supported"
-        })
+        user_cache.put(user_id, 'pre_question', user_question.lower(), "not supported")
         return
     if nearest_faq['score'] < 1:
-        cached_data[update.message.from_user.id]['fdbk'].update({
-            update.message.message_id: {
-                "user_question": user_question,
-                "nearest_faq": nearest_faq,
-            }
-        })
-    cached_data[update.message.from_user.id]['ofaqs'].update({update.message.message_id: other_faq_questions})
-    cached_data[update.message.from_user.id]['pre_question'].update({
-        user_question.lower(): {
+        user_cache.put(user_id, 'fdbk', update.message.message_id, {
+            "user_question": user_question,
             "nearest_faq": nearest_faq,
-            "other_faq_questions": other_faq_questions
-        }
+        })
+    user_cache.put(user_id, 'ofaqs', update.message.message_id, other_faq_questions)
+    user_cache.put(user_id, 'pre_question', user_question.lower(), {
+        "nearest_faq": nearest_faq,
+        "other_faq_questions": other_faq_questions
     })
 
 
-def load_cached_question_data(user_question: str, user_id):
-    user_question = user_question.lower()
-    nearest_faq = cached_data[user_id]['pre_question'][user_question]['nearest_faq']
-    other_faq_questions = cached_data[user_id]['pre_question'][user_question]['other_faq_questions']
-    return nearest_faq, other_faq_questions
-
-
 def handle_message(update: Update, context: CallbackContext):
-    if update.message.from_user.id not in cached_data:
-        cached_data[update.message.from_user.id] = cached_data_form
     user_question = update.message.text
     if user_question.startswith(f"@{telebot_config['bot_name']}"):
         user_question = user_question[len(f"@{telebot_config['bot_name']}"):]
         user_question = user_question.lstrip(' ').rstrip('\n').rstrip(' ')
     logging.info(f'user ({update.message.chat.id}) asked: {user_question}')
-    if user_question.lower() not in cached_data[update.message.from_user.id]['pre_question']:
-        endpoint = "/n-nearest-faqs"
-        response = requests.get(
-            main_api_url + endpoint,
-            params={
-                'question': user_question,
-                'n-returns': 1 + telebot_config['max_other_faqs'],
-                'secret_key': main_api_key
-            }
-        )
-        if response.status_code == 404:
+    cached_question_data = user_cache.get(update.message.from_user.id, 'pre_question', user_question.lower())
+    if cached_question_data is None:
+        try:
+            n_nearest_faqs = main_api.n_nearest_faqs(user_question, 1 + telebot_config['max_other_faqs'])
+        except requests.RequestException as e:
+            logging.error(f'Request to main api failed: {e}')
+            update.message.reply_text("Sorry! I can't answer right now, please try again later")
+            return
+        if n_nearest_faqs is None:
             cache_question_data(update, None, None)
             update.message.reply_text("Sorry! I can't find any FAQ related to your question")
             return
-        response = response.json()
-        nearest_faq = response['n-nearest-faqs'][0]
-        other_faq_questions = [item['question'] for item in response['n-nearest-faqs'][1:]]
+        nearest_faq = n_nearest_faqs[0]
+        other_faq_questions = [item['question'] for item in n_nearest_faqs[1:]]
         need_feedback = nearest_faq['score'] < 1
-    elif cached_data[update.message.from_user.id]['pre_question'][user_question.lower()] == "not supported":
+    elif cached_question_data == "not supported":
         update.message.reply_text("Sorry! I can't find any FAQ related to your question")
         return
     else:
-        nearest_faq, other_faq_questions = load_cached_question_data(user_question, update.message.from_user.id)
+        nearest_faq = cached_question_data['nearest_faq']
+        other_faq_questions = cached_question_data['other_faq_questions']
         need_feedback = False
     cache_question_data(update, nearest_faq, other_faq_questions)
     if nearest_faq['score'] < 1:
@@ -173,27 +158,28 @@ def handle_button(update: Update, context: CallbackContext) -> None:
         msg_id = int(msg_id)
         keyboard = [[InlineKeyboardButton("Show other similar FAQs", callback_data=f"ofaqs_{msg_id}")]]
         query.edit_message_reply_markup(reply_markup=InlineKeyboardMarkup(keyboard))
-        fdbk_data = cached_data[query.from_user.id]['fdbk'][msg_id]
-        cached_data[query.from_user.id]['fdbk'].pop(msg_id)
+        fdbk_data = user_cache.pop(query.from_user.id, 'fdbk', msg_id)
+        if fdbk_data is None:
+            # evicted or expired, the question it was about is no longer known
+            return
         if fdbk_type == 'pos':
             fdbk_data['related'] = True
         else:
             fdbk_data['related'] = False
-        r = requests.post(
-            main_api_url + "/send-feedback",
-            json={
-                'secret_key': main_api_key,
-                'feedback': fdbk_data
-            }
-        )
-        if r.status_code != 200:
-            logging.error(f'Request to sent feedback failed, status code = {r.status_code}')
+        try:
+            main_api.send_feedback(fdbk_data)
+        except requests.RequestException as e:
+            logging.error(f'Request to sent feedback failed: {e}')
 
     elif query.data.startswith('ofaqs'):
         _, msg_id = query.data.split('_')
         msg_id = int(msg_id)
+        other_faq_questions = user_cache.get(query.from_user.id, 'ofaqs', msg_id)
+        if other_faq_questions is None:
+            query.answer(text="Sorry! This question is too old, please ask it again")
+            return
         keyboard = []
-        for q_idx, question in enumerate(cached_data[query.from_user.id]['ofaqs'][msg_id]):
+        for q_idx, question in enumerate(other_faq_questions):
             keyboard.append([
                 InlineKeyboardButton(
                     question,
@@ -203,18 +189,44 @@ def handle_button(update: Update, context: CallbackContext) -> None:
         query.edit_message_reply_markup(reply_markup=InlineKeyboardMarkup(keyboard))
 
 
+def log_cache_stats(context: CallbackContext):
+    logging.info(f'User cache: {user_cache.stats()}')
+
+
+def refresh_faq_set(context: CallbackContext):
+    # embedded mode has no /update-faq-set, the FAQ set is reloaded from Firebase instead
+    main_api.load_faq_set()
+    logging.info(f'FAQ set reloaded: {len(main_api.all_faqs())} FAQs')
+
+
 def error(update: Update, context: CallbackContext):
     logging.error(f'Update {update} caused error {context.error}')
 
 
 if __name__ == '__main__':
-    updater = Updater(telebot_config['api_key'], use_context=True)
+    if isinstance(main_api, FAQService):
+        main_api.load_faq_set()
+        logging.info(f'Loaded FAQ set in process: {len(main_api.all_faqs())} FAQs')
+    elif main_api.check_connection():
+        logging.info(f'Connected to main api: url = {main_api_url}')
+
+    # handlers that call the main API run on a pool of `workers` threads, so a slow answer
+    # only holds up its own chat; the Telegram connection pool needs room for all of them
+    updater = Updater(telebot_config['api_key'],
+                      use_context=True,
+                      workers=telebot_config['workers'],
+                      request_kwargs={'con_pool_size': telebot_config['workers'] + 4})
     dp = updater.dispatcher
     dp.add_handler(CommandHandler('start', start_command))
     dp.add_handler(CommandHandler('help', help_command))
     dp.add_handler(CommandHandler('covid_info', covid_info_command))
-    dp.add_handler(MessageHandler(Filters.text, handle_message))
-    dp.add_handler(CallbackQueryHandler(handle_button))
+    dp.add_handler(MessageHandler(Filters.text, handle_message, run_async=True))
+    dp.add_handler(CallbackQueryHandler(handle_button, run_async=True))
     dp.add_error_handler(error)
+    updater.job_queue.run_repeating(log_cache_stats, interval=telebot_config['cache_stats_interval'])
+    if isinstance(main_api, FAQService) and telebot_config['faq_set_refresh_interval']:
+        updater.job_queue.run_repeating(refresh_faq_set,
+                                        interval=telebot_config['faq_set_refresh_interval'],
+                                        first=telebot_config['faq_set_refresh_interval'])
     updater.start_polling()
     updater.idle()
@@ -0,0 +1,6 @@
+import os
+import sys
+
+# tests import the modules the way the entry points in src/ do
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src'))
+os.environ.setdefault('DEFAULT_DEVICE', 'cpu')
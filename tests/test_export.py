@@ -0,0 +1,54 @@
+import os
+import sys
+
+import numpy as np
+import pytest
+import torch
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'benchmarks'))
+
+from common import encode_config, synthetic_questions, tiny_bert
+from sts.utils.backend import EXPORT_BACKENDS, TextVectorModule
+from sts.utils.embedder import TransformersEmbedder
+
+# the default --max-cosine-drift of export_model.py
+MAX_COSINE_DRIFT = 1e-4
+
+
+@pytest.fixture(scope='module')
+def bert():
+    return tiny_bert(hidden_size=32, num_hidden_layers=3)
+
+
+def cosine_drift(a, b):
+    return 1 - np.sum(a * b, axis=1) / (np.linalg.norm(a, axis=1) * np.linalg.norm(b, axis=1))
+
+
+@pytest.mark.parametrize('dynamic_padding', [False, True], ids=['max_length', 'dynamic'])
+@pytest.mark.parametrize('backend', ['torchscript', 'onnx'])
+def test_exported_model_matches_eager(bert, backend, dynamic_padding, tmp_path):
+    if backend == 'onnx':
+        pytest.importorskip('onnxruntime')
+    tokenizer, model = bert
+    config = encode_config()
+    device = torch.device('cpu')
+    questions = synthetic_questions(24, max_words=30)
+
+    path = str(tmp_path / f'text_vector.{EXPORT_BACKENDS[backend].extension}')
+    example = TransformersEmbedder.batch_encode(questions[:2], tokenizer, config, dynamic_padding=dynamic_padding)
+    EXPORT_BACKENDS[backend].export(TextVectorModule(model, dynamic_padding=dynamic_padding), *example, path)
+    exported = EXPORT_BACKENDS[backend](path, device)
+
+    # batch sizes and, with dynamic padding, sequence lengths other than the example's
+    for texts in [questions[:1], questions[2:10], questions]:
+        eager_embeddings = TransformersEmbedder.batch_text_vector(texts=texts,
+                                                                  pretrained_model=model,
+                                                                  tokenizer=tokenizer,
+                                                                  encode_config=config,
+                                                                  device=device,
+                                                                  return_tensors=False,
+                                                                  dynamic_padding=dynamic_padding)
+        exported_embeddings = exported(*TransformersEmbedder.batch_encode(texts, tokenizer, config,
+                                                                          dynamic_padding=dynamic_padding))
+        assert exported_embeddings.shape == eager_embeddings.shape
+        assert cosine_drift(eager_embeddings, exported_embeddings).max() <= MAX_COSINE_DRIFT
@@ -0,0 +1,75 @@
+import pandas as pd
+
+from data.faq_cache import FAQCache
+
+
+class InMemoryFirebaseDB:
+    # stands in for FirebaseDBManager, counting the reads FAQCache makes
+    def __init__(self, faqs):
+        self.faqs = faqs
+        self.reads = 0
+
+    def get_all_faqs(self) -> pd.DataFrame:
+        self.reads += 1
+        return pd.DataFrame(self.faqs)
+
+    def get_faq_by_question(self, question):
+        raise AssertionError('exact matches must not query Firebase')
+
+
+FAQS = [
+    {'question': 'What is COVID-19?', 'answer': 'A disease caused by a coronavirus.'},
+    {'question': 'Are  vaccines\tsafe?', 'answer': 'Yes.'}
+]
+
+
+def loaded_cache(faqs=FAQS):
+    firebase_db = InMemoryFirebaseDB(faqs)
+    faq_cache = FAQCache(firebase_db)
+    faq_cache.refresh()
+    return faq_cache, firebase_db
+
+
+def test_exact_match_ignores_whitespace_differences():
+    faq_cache, firebase_db = loaded_cache()
+    assert faq_cache.get_faq_by_question('What is COVID-19?') == FAQS[0]
+    assert faq_cache.get_faq_by_question('  What  is\nCOVID-19? ') == FAQS[0]
+    assert faq_cache.get_faq_by_question('Are vaccines safe?') == FAQS[1]
+    assert firebase_db.reads == 1
+
+
+def test_miss_returns_empty_dict():
+    faq_cache, _ = loaded_cache()
+    assert faq_cache.get_faq_by_question('what is covid-19?') == dict()
+    assert faq_cache.get_faq_by_question('How does it spread?') == dict()
+
+
+def test_empty_cache_misses():
+    assert FAQCache(InMemoryFirebaseDB(FAQS)).get_faq_by_question('What is COVID-19?') == dict()
+
+
+def test_returned_records_are_copies():
+    faq_cache, _ = loaded_cache()
+    faq = faq_cache.get_faq_by_question('What is COVID-19?')
+    faq['score'] = 1
+    faq['answer'] = 'changed'
+    assert faq_cache.get_faq_by_question('What is COVID-19?') == FAQS[0]
+
+
+def test_first_duplicate_question_wins():
+    faq_cache, _ = loaded_cache(FAQS + [{'question': 'What is COVID-19?', 'answer': 'Duplicate.'}])
+    assert faq_cache.get_faq_by_question('What is COVID-19?') == FAQS[0]
+
+
+def test_refresh_replaces_index():
+    faq_cache, firebase_db = loaded_cache()
+    firebase_db.faqs = [
+        {'question': 'What is COVID-19?', 'answer': 'Updated answer.'},
+        {'question': 'How long is the quarantine?', 'answer': '10 days.'}
+    ]
+    faq_data = faq_cache.refresh()
+    assert firebase_db.reads == 2
+    assert faq_data.equals(faq_cache.faqs)
+    assert faq_cache.get_faq_by_question('What is COVID-19?')['answer'] == 'Updated answer.'
+    assert faq_cache.get_faq_by_question('How long is the quarantine?')['answer'] == '10 days.'
+    assert faq_cache.get_faq_by_question('Are vaccines safe?') == dict()
@@ -0,0 +1,140 @@
+import copy
+import itertools
+
+import pytest
+
+from data.firebase import FirebaseDBManager
+
+
+class InMemoryDatabase:
+    """
+    Stand-in for the pyrebase database of FirebaseDBManager: a nested dict, addressed with child(),
+    that records every write.
+    """
+
+    def __init__(self, data=None, path=(), root=None):
+        self._root = root if root is not None else self
+        self._path = path
+        if root is None:
+            self.data = data if data is not None else dict()
+            self.writes = []
+            self._keys = itertools.count()
+
+    def child(self, name):
+        return InMemoryDatabase(path=self._path + (name,), root=self._root)
+
+    def _node(self, create=False):
+        node = self._root.data
+        for name in self._path:
+            if name not in node:
+                if not create:
+                    return None
+                node[name] = dict()
+            node = node[name]
+        return node
+
+    def get(self):
+        node = copy.deepcopy(self._node())
+        return type('Response', (), {'val': lambda _: node or None})()
+
+    def generate_key(self):
+        return '-key{:06d}'.format(next(self._root._keys))
+
+    def update(self, data):
+        self._root.writes.append(('update', self._path))
+        node = self._node(create=True)
+        for key, value in data.items():
+            if value is None:
+                node.pop(key, None)
+            else:
+                node[key] = copy.deepcopy(value)
+
+
+def firebase_db(faqs=None):
+    db = FirebaseDBManager.__new__(FirebaseDBManager)
+    db._db = InMemoryDatabase({'FAQ': dict(faqs)} if faqs else None)
+    return db
+
+
+def stored_faqs(db):
+    return sorted(db._db.data.get('FAQ', dict()).values(), key=lambda faq: (faq['question'], faq['answer']))
+
+
+STORED = {
+    '-a': {'question': 'What is COVID-19?', 'answer': 'A disease.'},
+    '-b': {'question': 'Are vaccines safe?', 'answer': 'Yes.'},
+    '-c': {'question': 'Is it over?', 'answer': 'No.'}
+}
+
+
+def test_sync_applies_only_the_diff_in_one_update():
+    db = firebase_db(STORED)
+    faqs = [
+        {'question': 'What is COVID-19?', 'answer': 'A disease.'},
+        {'question': 'Are vaccines safe?', 'answer': 'Yes, they are.'},
+        {'question': 'How does it spread?', 'answer': 'Through the air.'}
+    ]
+    changes = db.sync_faqs(faqs)
+    assert changes == {
+        'inserted': ['How does it spread?'],
+        'updated': ['Are vaccines safe?'],
+        'deleted': ['Is it over?'],
+        'unchanged': 1
+    }
+    assert db._db.writes == [('update', ('FAQ',))]
+    assert stored_faqs(db) == sorted(faqs, key=lambda faq: (faq['question'], faq['answer']))
+    # unchanged and updated FAQs keep their keys
+    assert db._db.data['FAQ']['-a'] == faqs[0]
+    assert db._db.data['FAQ']['-b'] == faqs[1]
+    assert '-c' not in db._db.data['FAQ']
+
+
+def test_dry_run_writes_nothing():
+    db = firebase_db(STORED)
+    changes = db.sync_faqs([{'question': 'How does it spread?', 'answer': 'Through the air.'}], dry_run=True)
+    assert changes['inserted'] == ['How does it spread?']
+    assert sorted(changes['deleted']) == sorted(faq['question'] for faq in STORED.values())
+    assert db._db.writes == []
+    assert db._db.data['FAQ'] == STORED
+
+
+def test_resync_is_a_no_op():
+    db = firebase_db(STORED)
+    faqs = list(STORED.values())
+    changes = db.sync_faqs(faqs)
+    assert changes == {'inserted': [], 'updated': [], 'deleted': [], 'unchanged': 3}
+    assert db._db.writes == []
+
+
+def test_sync_into_empty_node():
+    db = firebase_db()
+    faqs = list(STORED.values())
+    assert db.sync_faqs(faqs)['inserted'] == [faq['question'] for faq in faqs]
+    assert db._db.writes == [('update', ('FAQ',))]
+    assert db.sync_faqs(faqs)['unchanged'] == 3
+    assert len(db._db.writes) == 1
+
+
+def test_duplicate_questions_are_matched_one_to_one():
+    db = firebase_db({
+        '-a': {'question': 'What is COVID-19?', 'answer': 'First.'},
+        '-b': {'question': 'What is COVID-19?', 'answer': 'Second.'},
+        '-c': {'question': 'What is COVID-19?', 'answer': 'Third.'}
+    })
+    faqs = [
+        {'question': 'What is COVID-19?', 'answer': 'First.'},
+        {'question': 'What is COVID-19?', 'answer': 'Changed.'}
+    ]
+    changes = db.sync_faqs(faqs)
+    assert changes == {'inserted': [], 'updated': ['What is COVID-19?'], 'deleted': ['What is COVID-19?'],
+                       'unchanged': 1}
+    assert stored_faqs(db) == sorted(faqs, key=lambda faq: faq['answer'])
+    assert db.sync_faqs(faqs + [faqs[1]])['inserted'] == ['What is COVID-19?']
+    assert len(db._db.data['FAQ']) == 3
+
+
+def test_invalid_faq_is_rejected_before_any_write():
+    db = firebase_db(STORED)
+    with pytest.raises(AssertionError):
+        db.sync_faqs([{'question': 'What is COVID-19?'}])
+    assert db._db.writes == []
@@ -0,0 +1,72 @@
+import multiprocessing
+import os
+
+from metrics import MetricsRegistry
+
+
+def record(dirpath, requests, seconds):
+    registry = MetricsRegistry()
+    registry.share(dirpath)
+    for _ in range(requests):
+        registry.counter('api_requests_total', 'Requests', endpoint='/', status=200).inc()
+        registry.histogram('api_request_seconds', 'Latency', endpoint='/').observe(seconds)
+    registry.write()
+
+
+def samples(text):
+    return dict(line.rsplit(' ', 1) for line in text.splitlines() if not line.startswith('#'))
+
+
+def test_render_adds_up_every_process(tmp_path):
+    dirpath = str(tmp_path)
+    # a process of its own, as a forked gunicorn worker would be
+    process = multiprocessing.get_context('spawn').Process(target=record, args=(dirpath, 3, 0.02))
+    process.start()
+    process.join()
+    assert process.exitcode == 0
+
+    registry = MetricsRegistry()
+    registry.share(dirpath)
+    registry.counter('api_requests_total', 'Requests', endpoint='/', status=200).inc(2)
+    registry.counter('api_requests_total', 'Requests', endpoint='/', status=404).inc()
+    registry.histogram('api_request_seconds', 'Latency', endpoint='/').observe(0.2)
+    assert len(os.listdir(dirpath)) == 2
+
+    values = samples(registry.render())
+    assert values['api_requests_total{endpoint="/",status="200"}'] == '5'
+    assert values['api_requests_total{endpoint="/",status="404"}'] == '1'
+    assert values['api_request_seconds_count{endpoint="/"}'] == '4'
+    assert values['api_request_seconds_bucket{endpoint="/",le="0.025"}'] == '3'
+    assert values['api_request_seconds_bucket{endpoint="/",le="0.25"}'] == '4'
+    assert abs(float(values['api_request_seconds_sum{endpoint="/"}']) - 0.26) < 1e-9
+    # summed over processes, so no worker label
+    assert 'worker=' not in registry.render()
+
+
+def test_reset_keeps_metrics_registered():
+    registry = MetricsRegistry()
+    counter = registry.counter('faq_exact_matches_total', 'Exact matches')
+    counter.inc(4)
+    registry.reset()
+    counter.inc()
+    assert samples(registry.render())['faq_exact_matches_total{worker="%d"}' % os.getpid()] == '1'
+
+
+def test_collectors_run_before_render_and_go_with_their_object():
+    registry = MetricsRegistry()
+    entries = registry.gauge('sts_query_cache_entries', 'Entries')
+
+    class Cache:
+        size = 3
+
+        def collect(self):
+            entries.set(self.size)
+
+    cache = Cache()
+    registry.add_collector(cache.collect)
+    assert samples(registry.render())['sts_query_cache_entries{worker="%d"}' % os.getpid()] == '3'
+    cache.size = 5
+    assert samples(registry.render())['sts_query_cache_entries{worker="%d"}' % os.getpid()] == '5'
+    del cache
+    registry.render()
+    assert registry._collectors == []
@@ -0,0 +1,47 @@
+import json
+import os
+
+import pytest
+
+from sts.utils.preprocessor import TextPreprocessor
+
+TESTS_DIRPATH = os.path.dirname(os.path.abspath(__file__))
+PRETRAINED_CONFIG_DIRPATH = os.path.join(os.path.dirname(TESTS_DIRPATH), 'config', 'sts', 'pretrained_config',
+                                         'digitalepidemiologylab')
+
+# Corpus of rewrite-table keys, mixed-case variants, emojis, control and punctuation characters,
+# with the outputs of normalize_text before its rewrite tables were compiled into one detector pass.
+# Hashtags are segmented from the recorded segmentations, so ekphrasis is never loaded
+with open(os.path.join(TESTS_DIRPATH, 'data', 'preprocessor_golden.json')) as JSON:
+    GOLDEN = json.loads(JSON.read())
+
+
+@pytest.fixture(autouse=True)
+def recorded_hashtag_segmentations(monkeypatch):
+    def no_segmenter():
+        raise AssertionError('hashtag missing from the recorded segmentations')
+
+    monkeypatch.setattr(TextPreprocessor, '_segmenter', staticmethod(no_segmenter))
+    TextPreprocessor._hashtag_segmentations.clear()
+    for hashtag, segmented in GOLDEN['hashtag_segmentations'].items():
+        TextPreprocessor._hashtag_segmentations.put(hashtag, segmented)
+    yield
+    TextPreprocessor._hashtag_segmentations.clear()
+
+
+def preprocessing_config(model):
+    with open(os.path.join(PRETRAINED_CONFIG_DIRPATH, model, 'preprocessing.json')) as JSON:
+        return json.loads(JSON.read())
+
+
+@pytest.mark.parametrize('model', sorted(GOLDEN['expected']))
+def test_normalize_text_matches_golden_outputs(model):
+    config = preprocessing_config(model)
+    for text, expected in zip(GOLDEN['corpus'], GOLDEN['expected'][model]):
+        assert TextPreprocessor.normalize_text(text, config=config) == expected, repr(text)
+
+
+@pytest.mark.parametrize('model', sorted(GOLDEN['expected']))
+def test_normalize_texts_matches_golden_outputs(model):
+    assert TextPreprocessor.normalize_texts(GOLDEN['corpus'], n_jobs=1,
+                                            config=preprocessing_config(model)) == GOLDEN['expected'][model]
@@ -0,0 +1,190 @@
+import json
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from data.who import WHOFAQCrawler
+
+FIXTURES_DIRPATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'who')
+
+
+def fixture_html(name):
+    with open(os.path.join(FIXTURES_DIRPATH, name), encoding='utf-8') as f:
+        return f.read()
+
+
+class WHOSite:
+    """
+    Local stand-in for the WHO site: serves saved pages by path, answers conditional GETs whose
+    validators match with 304 and records every request it receives.
+    """
+
+    def __init__(self):
+        # path -> {'text', 'etag', 'last_modified', 'delay'}
+        self.pages = dict()
+        self.requests = []
+        site = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                site.requests.append((self.path, dict(self.headers)))
+                page = site.pages.get(self.path)
+                if page is None:
+                    self.send_response(404)
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return
+                time.sleep(page.get('delay', 0))
+                if (page.get('etag') and self.headers.get('If-None-Match') == page['etag']) or \
+                        (page.get('last_modified') and self.headers.get('If-Modified-Since') == page['last_modified']):
+                    self.send_response(304)
+                    self.end_headers()
+                    return
+                body = page['text'].encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/html; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                if page.get('etag'):
+                    self.send_header('ETag', page['etag'])
+                if page.get('last_modified'):
+                    self.send_header('Last-Modified', page['last_modified'])
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self._server = ThreadingHTTPServer(('localhost', 0), Handler)
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+
+    def url(self, path):
+        return f'http://localhost:{self._server.server_port}{path}'
+
+    def requests_for(self, path):
+        return [headers for request_path, headers in self.requests if request_path == path]
+
+    def close(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+
+@pytest.fixture
+def who_site():
+    site = WHOSite()
+    site.pages['/covid-19'] = {'text': fixture_html('coronavirus-disease-covid-19.html'), 'etag': '"v1"'}
+    site.pages['/vaccines'] = {'text': fixture_html('vaccines.html'),
+                               'last_modified': 'Tue, 01 Jun 2021 10:00:00 GMT'}
+    yield site
+    site.close()
+
+
+def test_etag_revalidation_serves_unchanged_page_from_disk(who_site, tmp_path):
+    url = who_site.url('/covid-19')
+    first = WHOFAQCrawler.fetch(url, cache_dirpath=str(tmp_path))
+    assert first == fixture_html('coronavirus-disease-covid-19.html')
+    with open(WHOFAQCrawler._cache_path(str(tmp_path), url)) as JSON:
+        assert json.loads(JSON.read())['etag'] == '"v1"'
+
+    # the site no longer has the body, a 304 can only be answered from the cache
+    who_site.pages['/covid-19']['text'] = 'not sent on a 304'
+    assert WHOFAQCrawler.fetch(url, cache_dirpath=str(tmp_path)) == first
+    assert 'If-None-Match' not in who_site.requests_for('/covid-19')[0]
+    assert who_site.requests_for('/covid-19')[1]['If-None-Match'] == '"v1"'
+
+
+def test_changed_page_replaces_cached_copy(who_site, tmp_path):
+    url = who_site.url('/covid-19')
+    WHOFAQCrawler.fetch(url, cache_dirpath=str(tmp_path))
+    who_site.pages['/covid-19'] = {'text': fixture_html('vaccines.html'), 'etag': '"v2"'}
+    assert WHOFAQCrawler.fetch(url, cache_dirpath=str(tmp_path)) == fixture_html('vaccines.html')
+    who_site.pages['/covid-19']['text'] = 'not sent on a 304'
+    assert WHOFAQCrawler.fetch(url, cache_dirpath=str(tmp_path)) == fixture_html('vaccines.html')
+    assert who_site.requests_for('/covid-19')[2]['If-None-Match'] == '"v2"'
+
+
+def test_last_modified_revalidation(who_site, tmp_path):
+    url = who_site.url('/vaccines')
+    first = WHOFAQCrawler.fetch(url, cache_dirpath=str(tmp_path))
+    who_site.pages['/vaccines']['text'] = 'not sent on a 304'
+    assert WHOFAQCrawler.fetch(url, cache_dirpath=str(tmp_path)) == first
+    assert who_site.requests_for('/vaccines')[1]['If-Modified-Since'] == 'Tue, 01 Jun 2021 10:00:00 GMT'
+
+
+def test_without_cache_dir_every_fetch_downloads(who_site):
+    url = who_site.url('/covid-19')
+    with WHOFAQCrawler.session() as session:
+        assert WHOFAQCrawler.fetch(url, session=session) == fixture_html('coronavirus-disease-covid-19.html')
+        who_site.pages['/covid-19']['text'] = 'changed'
+        assert WHOFAQCrawler.fetch(url, session=session) == 'changed'
+    for headers in who_site.requests_for('/covid-19'):
+        assert 'If-None-Match' not in headers and 'If-Modified-Since' not in headers
+
+
+def test_faq_dataset_keeps_source_order(who_site, tmp_path, monkeypatch):
+    config_path = tmp_path / 'who_faq.json'
+    config_path.write_text(json.dumps({
+        'source_urls': [],
+        'max_workers': 4,
+        'timeout': 5,
+        'retries': 0,
+        'backoff_factor': 0
+    }))
+    monkeypatch.setenv('WHO_FAQ_URLS_PATH', str(config_path))
+    # the first page answers last, the dataset must still list it first
+    who_site.pages['/covid-19']['delay'] = 0.3
+    source_urls = [who_site.url('/covid-19'), who_site.url('/vaccines')]
+    cache_dirpath = str(tmp_path / 'cache')
+
+    qa_df = WHOFAQCrawler.faq_dataset(source_urls, cache_dirpath=cache_dirpath)
+    assert list(qa_df.question) == ['What is COVID-19?',
+                                    'What are the symptoms of COVID-19?',
+                                    'Are COVID-19 vaccines safe?']
+    assert qa_df.answer.iloc[0] == ('COVID-19 is the disease caused by a new coronavirus called SARS-CoV-2.\n'
+                                    'WHO first learned of this new virus on 31 December 2019.')
+    assert qa_df.answer.iloc[2] == 'Yes. Vaccines go through rigorous testing\nbefore they are approved.'
+
+    # a second crawl revalidates both pages and rebuilds the same dataset from the cache
+    for page in who_site.pages.values():
+        page['text'] = 'not sent on a 304'
+    assert WHOFAQCrawler.faq_dataset(source_urls, cache_dirpath=cache_dirpath).equals(qa_df)
+
+
+@pytest.mark.parametrize('name, expected', [
+    ('coronavirus-disease-covid-19.html', [
+        ('What is COVID-19?',
+         'COVID-19 is the disease caused by a new coronavirus called SARS-CoV-2.\n'
+         'WHO first learned of this new virus on 31 December 2019.'),
+        ('What are the symptoms of COVID-19?',
+         'The most common symptoms of COVID-19 are\nfever, dry cough and fatigue.')
+    ]),
+    ('vaccines.html', [
+        ('Are COVID-19 vaccines safe?', 'Yes. Vaccines go through rigorous testing\nbefore they are approved.'),
+        ('What is COVID-19?', 'A duplicate question, dropped from the dataset.')
+    ])
+])
+def test_preprocess_fixture_pages(name, expected, monkeypatch):
+    monkeypatch.setattr(WHOFAQCrawler, 'fetch', lambda url, **kwargs: fixture_html(name))
+    questions, answers = WHOFAQCrawler.crawl_qas(name)
+    # as faq_dataset extracts them
+    assert [(WHOFAQCrawler.preprocess(q.get_text(' ', strip=True)),
+             WHOFAQCrawler.preprocess(a.get_text('\n', strip=True))) for q, a in zip(questions, answers)] == expected
+
+
+@pytest.mark.parametrize('text, expected', [
+    ('a\tb', 'a b'),
+    ('a    b', 'a b'),
+    ('a \n \n b', 'a\nb'),
+    ('a\n\n\nb', 'a\nb'),
+    ('fever\n, dry cough', 'fever, dry cough'),
+    ('x\n (y)\n.', 'x(y).'),
+    # the previous pass-by-pass cleanup left 'a\n.' for these, punctuation now always sticks to the word
+    ('a\n\n.', 'a.'),
+    ('a\n\n\n\n.', 'a.'),
+    ('a \n \n, b', 'a, b')
+])
+def test_preprocess_whitespace(text, expected):
+    assert WHOFAQCrawler.preprocess(text) == expected
@@ -1,9 +1,21 @@
+import argparse
+
 from src.data.firebase import FirebaseDBManager
 from src.data.who import WHOFAQCrawler
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--dry-run',
+                        action='store_true',
+                        help='only print the changes that would be written')
+    args = parser.parse_args()
+
     firebase_db = FirebaseDBManager()
-    firebase_db.clear_all_faqs()
     qa_df = WHOFAQCrawler.faq_dataset()
-    for faq in qa_df.to_dict(orient='records'):
-        firebase_db.push_faq(faq)
+    changes = firebase_db.sync_faqs(qa_df.to_dict(orient='records'), dry_run=args.dry_run)
+    for change in ['inserted', 'updated', 'deleted']:
+        for question in changes[change]:
+            print(f'{change}: {question}')
+    print('{} inserted, {} updated, {} deleted, {} unchanged{}'.format(
+        len(changes['inserted']), len(changes['updated']), len(changes['deleted']), changes['unchanged'],
+        ' (dry run)' if args.dry_run else ''))